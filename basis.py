@@ -0,0 +1,219 @@
+'''
+Return the value of the probe function, based on a Legendre expansion in basis.h5.
+
+The logarithm of the probe function is expanded as
+
+    log R(r, θ, t) = Σ_ij C[i, j, k] P_i(2r³ - 1) P_j(cosθ),  t in the k-th t bin,
+
+where P_i are Legendre polynomials. In t the coefficients stay one matrix per
+t bin rather than a spline or Legendre expansion: log R of a smooth t basis
+has no closed-form time integral, while piecewise constant t keeps get_mu an
+exact finite sum. The probe is positive everywhere, so log R is finite.
+The training cells are uniform in r³ and cosθ, so the fit constrains the
+polynomials evenly over [-1, 1], down to the centre of the detector.
+'''
+
+import argparse
+import os
+import tempfile
+import h5py
+import numpy as np
+from numpy.polynomial import legendre
+from coefficient import ProbeBase
+
+# probe函数积分上限(ns)
+T_MAX = 1000
+# 每次计算的点数
+CHUNK = 2**16
+
+def basis(rs, thetas, deg_r, deg_theta):
+    '''
+    Return the products P_i(2r³ - 1) P_j(cosθ) of the points, with shape
+    (n, (deg_r + 1) * (deg_theta + 1)) and i major, so that log R of every
+    t bin is a single matrix product with the flattened coefficients.
+    '''
+    p_r = legendre.legvander(2 * np.ravel(rs) ** 3 - 1, deg_r)
+    p_theta = legendre.legvander(np.cos(np.ravel(thetas)), deg_theta)
+    return (p_r[:, :, None] * p_theta[:, None, :]).reshape(len(p_r), -1)
+
+class BasisProbe(ProbeBase):
+    '''
+    Return the value of the probe function, based on basis.h5.
+
+    The state is a (deg_r + 1, deg_theta + 1, tbins) coefficient tensor,
+    a few KB for typical degrees, instead of a dense histogram cube.
+    '''
+
+    def __init__(self, filename="./basis.h5"):
+        with h5py.File(filename, 'r') as h5file_r:
+            self.coefficients = h5file_r["Coefficients"][()]
+        self.deg_r = self.coefficients.shape[0] - 1
+        self.deg_theta = self.coefficients.shape[1] - 1
+        self.tbins = self.coefficients.shape[2]
+        # ((deg_r + 1) * (deg_theta + 1), tbins), 与basis()的列对应
+        self.flat = self.coefficients.reshape(-1, self.tbins)
+
+    def get_log_lc_all(self, rs, thetas):
+        '''
+        Return log R(r, θ, t) of every t bin, with shape (n, tbins).
+        '''
+        return basis(rs, thetas, self.deg_r, self.deg_theta) @ self.flat
+
+    def get_mu(self, rs, thetas):
+        rs = np.asarray(rs)
+        mu = np.empty(rs.size)
+        for i in range(0, rs.size, CHUNK):
+            log_lc = self.get_log_lc_all(np.ravel(rs)[i:i+CHUNK],
+                                         np.ravel(thetas)[i:i+CHUNK])
+            mu[i:i+CHUNK] = np.sum(np.exp(log_lc), axis=1) * T_MAX / self.tbins
+        return mu.reshape(rs.shape)
+
+    def get_lc_antiderivative(self, rs, thetas, ts):
+        '''
+        Return the integral of R from 0 to t, one basis evaluation per chunk
+        for all t bins, so that `integrate_lc` does not evaluate the basis
+        once per t bin.
+        '''
+        rs = np.asarray(rs)
+        starts = np.arange(self.tbins) * T_MAX / self.tbins
+        integral = np.empty(rs.size)
+        for i in range(0, rs.size, CHUNK):
+            log_lc = self.get_log_lc_all(np.ravel(rs)[i:i+CHUNK],
+                                         np.ravel(thetas)[i:i+CHUNK])
+            # 每个t格子在[0, t]中的长度
+            width = np.clip(np.ravel(ts)[i:i+CHUNK, None] - starts, 0, T_MAX / self.tbins)
+            integral[i:i+CHUNK] = np.sum(np.exp(log_lc) * width, axis=1)
+        return integral.reshape(rs.shape)
+
+    def get_log_lc(self, rs, thetas, ts):
+        rs = np.asarray(rs)
+        ts_cliped = np.clip(np.ravel(ts), 0, (1 - 1e-15) * T_MAX)
+        t_grid = (ts_cliped * self.tbins / T_MAX).astype(int)
+        log_lc = np.empty(rs.size)
+        for i in range(0, rs.size, CHUNK):
+            # 一次矩阵乘法得到所有t格子, 再取各点所在的t格子
+            log_all = self.get_log_lc_all(np.ravel(rs)[i:i+CHUNK],
+                                          np.ravel(thetas)[i:i+CHUNK])
+            log_lc[i:i+CHUNK] = np.take_along_axis(
+                log_all, t_grid[i:i+CHUNK, None], axis=1)[:, 0]
+        return log_lc.reshape(rs.shape)
+
+    def get_lc(self, rs, thetas, ts):
+        return np.exp(self.get_log_lc(rs, thetas, ts))
+
+def fit(sum_probe, num, r_bins, theta_bins, deg_r, deg_theta, ridge=1e-6):
+    '''
+    Fit the coefficients to binned PE counts and exposures.
+
+    For every t bin, log((counts + 1/2) / (exposure · Δt)) of the (r, θ) cells
+    is fitted by weighted least squares with weights counts + 1/2, the inverse
+    variance of the logarithm of a Poisson count. The normal equations of all
+    t bins are solved as one batch.
+
+    Returns
+    -------
+    numpy.ndarray
+        The coefficients, with shape (deg_r + 1, deg_theta + 1, tbins).
+    '''
+    tbins = sum_probe.shape[2]
+    r_mid = ((r_bins[1:] ** 3 + r_bins[:-1] ** 3) / 2) ** (1/3)
+    cos_mid = (np.cos(theta_bins[1:]) + np.cos(theta_bins[:-1])) / 2
+    rs, thetas = np.meshgrid(r_mid, np.arccos(cos_mid), indexing='ij')
+    # (cells, (deg_r + 1) * (deg_theta + 1))
+    design = basis(rs, thetas, deg_r, deg_theta)
+
+    exposure = num.reshape(-1, 1)
+    counts = sum_probe.reshape(-1, tbins) + 0.5
+    weight = np.where(exposure > 0, counts, 0)
+    target = np.log(counts / np.maximum(exposure, 1) * tbins / T_MAX)
+
+    gram = np.einsum('ck,ci,cj->kij', weight, design, design)
+    gram += ridge * np.trace(gram, axis1=1, axis2=2)[:, None, None] \
+        * np.eye(design.shape[1])
+    rhs = np.einsum('ck,ci,ck->ki', weight, design, target)
+    coefficients = np.linalg.solve(gram, rhs[:, :, None])[:, :, 0]
+    return coefficients.T.reshape(deg_r + 1, deg_theta + 1, tbins)
+
+def check(filename, concat_file, sum_probe, num, r_bins, theta_bins, jobs=1):
+    '''
+    Score the BasisProbe in `filename` and the histogram it was fitted to on a
+    concat file, and raise if the fit scores worse than the histogram.
+    '''
+    import histogram
+    from coefficient import ConcatInfo
+    from probe import Probe
+
+    concat = ConcatInfo(concat_file, stream=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "histogram.h5")
+        histogram.write_probe(source, sum_probe, num, r_bins, theta_bins)
+        source_score = Probe(source).validate_concat(concat, jobs)
+    score = BasisProbe(filename).validate_concat(concat, jobs)
+    print(f"basis {score}, histogram {source_score}")
+    if score < source_score:
+        raise ValueError(f"{filename} scores {score} on {concat_file}, worse than "
+                         f"the histogram it was fitted to, {source_score}")
+
+def main():
+    '''
+    Fit a BasisProbe from the training data and save it to an HDF5 file.
+
+    The PE counts and exposures are accumulated by histogram.py on a fine grid,
+    uniform in r³ and in cosθ over [0, π], then fitted by `fit`.
+
+    The optional ``--concat`` report scores the fit and that histogram on a
+    held-out concat file with `check`, and the output is only written when
+    the fit is not worse. It guards against a broken fit; tuning the degrees
+    on the held-out set would overfit to it.
+
+    ```bash
+    python3 basis.py -g geo.h5 --data data -o basis.h5 -b 50 -t 50 --deg-r 8 --deg-theta 8
+    ```
+    '''
+    psr = argparse.ArgumentParser()
+    psr.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
+    psr.add_argument("--data", dest="data", type=str, nargs="+",
+                     help="training data files, globs or folders")
+    psr.add_argument("-o", "--output", dest="opt", type=str, help="output file")
+    psr.add_argument("-b", "--bins", dest="bins", type=int, default=50,
+                     help="r and θ bins of the fitted grid")
+    psr.add_argument("-t", "--tbins", dest="tbins", type=int, default=50,
+                     help="t bins")
+    psr.add_argument("--deg-r", dest="deg_r", type=int, default=8,
+                     help="Legendre degree in r")
+    psr.add_argument("--deg-theta", dest="deg_theta", type=int, default=8,
+                     help="Legendre degree in cosθ")
+    psr.add_argument("--max-memory", dest="max_memory", type=float, default=1024,
+                     help="memory limit of the geometry stage per worker (MB)")
+    psr.add_argument("--cache", dest="cache", type=str, default=None,
+                     help="geometry cache directory")
+    psr.add_argument("--concat", dest="concat", type=str, default=None,
+                     help="held-out concat file to report the fit and the histogram on")
+    psr.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                     help="number of worker processes")
+    args = psr.parse_args()
+
+    import histogram
+
+    r_bins = (np.arange(args.bins+1) / args.bins) ** (1/3)
+    theta_bins = np.arccos(1 - 2 * np.arange(args.bins+1) / args.bins)
+    sum_probe, num = histogram.accumulate(
+        args.geo, histogram.get_files(args.data), r_bins, theta_bins, args.tbins,
+        histogram.get_chunk(args.max_memory), args.jobs, args.cache)
+    coefficients = fit(sum_probe, num, r_bins, theta_bins, args.deg_r, args.deg_theta)
+
+    # 先写入临时文件, 通过检查后再改名, 失败时不留下输出文件
+    tmp = f"{args.opt}.{os.getpid()}.tmp"
+    try:
+        with h5py.File(tmp, 'w') as h5file_w:
+            h5file_w.create_dataset('Coefficients', data=coefficients)
+        if args.concat is not None:
+            check(tmp, args.concat, sum_probe, num, r_bins, theta_bins, args.jobs)
+        os.replace(tmp, args.opt)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+'''
+Benchmark the probe pipeline on synthetic data.
+
+Every stage of histogram.py, probe.py, coefficient.py and draw.py is timed on
+files written by synthetic.py, for one or several data sizes. For each stage
+the wall time, the number of items processed, the throughput, the peak of
+traced memory (with --memory) and the peak RSS of the process are reported.
+The probe built from the synthetic training files is scored next to the
+analytic truth, so a faster path that changes the score shows up directly.
+
+```bash
+python3 bench.py --pmts 17612 --vertices 2000 --test-vertices 500 --scales 1 2 4 -o bench.json
+```
+'''
+
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+import histogram
+import probe
+import synthetic
+from coefficient import ConcatInfo
+
+def measure(rows, stage, items, func, memory=False, **extra):
+    '''
+    Run `func`, append its timing to `rows` and return its result.
+    '''
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    rows.append({
+        **extra,
+        "stage": stage,
+        "seconds": seconds,
+        "items": items,
+        "throughput": items / seconds if seconds > 0 else float("inf"),
+        "peak_mb": peak,
+        "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    print(f"{stage:24s} {seconds:10.4f} s {rows[-1]['throughput']:14.1f} items/s")
+    return result
+
+def bench(directory, args, scale):
+    '''
+    Generate a data set of the given `scale` in `directory` and time every stage.
+    '''
+    import matplotlib.pyplot as plt
+    import draw
+
+    rows = []
+    extra = {"scale": scale}
+    truth = synthetic.AnalyticProbe(args.lambda0)
+    n_vertex = args.vertices * scale
+    geo_file = os.path.join(directory, "geo.h5")
+    concat_file = os.path.join(directory, "concat.h5")
+    histogram_file = os.path.join(directory, "histogram.h5")
+    files = [os.path.join(directory, f"{16001 + i}.h5") for i in range(args.files)]
+
+    synthetic.write_geometry(geo_file, args.pmts)
+    pmt = synthetic.read_pmt(geo_file)
+    for seed, filename in enumerate(files, 16001):
+        synthetic.write_training(filename, pmt, n_vertex, seed, truth)
+    synthetic.write_concat(concat_file, pmt, args.test_vertices * scale, 16000, truth)
+    n_pair = n_vertex * len(pmt)
+
+    bins, tbins = args.bins, args.tbins
+    r_bins = (np.arange(bins+1) / bins) ** (1/3)
+    theta_bins = np.arccos(np.arange(bins+1) / bins)[::-1]
+    chunk = histogram.get_chunk(args.max_memory)
+    argument = (pmt, bins, tbins, r_bins, theta_bins, chunk, None)
+    measure(rows, "histogram.get_probe", n_pair,
+            lambda: histogram.get_probe((files[0], 0, n_vertex, argument, None)),
+            args.memory, **extra)
+    sum_probe, num = measure(
+        rows, "histogram.accumulate", n_pair * len(files),
+        lambda: histogram.accumulate(geo_file, files, r_bins, theta_bins, tbins,
+                                     chunk, args.jobs),
+        args.memory, **extra)
+    histogram.write_probe(histogram_file, sum_probe, num, r_bins, theta_bins)
+
+    probe.tables.clear()
+    p = probe.Probe(histogram_file)
+    measure(rows, "Probe.load_data", bins * bins * tbins, p.load_data,
+            args.memory, **extra)
+
+    concat = ConcatInfo(concat_file)
+    measure(rows, "Probe.get_lc", concat.n_pe,
+            lambda: p.get_lc(concat.pe_rs, concat.pe_thetas, concat.pe_ts),
+            args.memory, **extra)
+    measure(rows, "Probe.get_mu", concat.n_v,
+            lambda: p.get_mu(concat.v_rs, concat.v_thetas), args.memory, **extra)
+    measure(rows, "ProbeBase.is_consistent", concat.n_v,
+            lambda: p.is_consistent(concat.v_rs, concat.v_thetas),
+            args.memory, **extra)
+    stream = ConcatInfo(concat_file, stream=True)
+    score = measure(rows, "ProbeBase.validate", concat.n_pe + concat.n_v,
+                    lambda: p.validate_concat(stream), args.memory, **extra)
+    truth_score = truth.validate_concat(stream)
+    rows[-1]["score"] = score
+    rows[-1]["truth_score"] = truth_score
+
+    r, theta, _ = draw.hist_rths[0]
+    panels = [
+        ("draw.pie", lambda fig, ax: draw.draw_pie(p, fig, ax)),
+        ("draw.real_pie", lambda fig, ax: draw.real_pie(concat, fig, ax)),
+        ("draw.quotient", lambda fig, ax: draw.verf(p, concat, fig, ax)),
+        ("draw.time_hist",
+         lambda fig, ax: draw.draw_time_hist(p, concat, r, theta, fig, ax)),
+    ]
+    for stage, panel in panels:
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1, projection=None if stage == "draw.time_hist"
+                             else "polar")
+        measure(rows, stage, concat.n_pe, lambda: panel(fig, ax), args.memory, **extra)
+        plt.close(fig)
+    return rows
+
+def write_report(filename, rows):
+    '''
+    Write the rows as JSON, or as CSV when `filename` ends with ``.csv``.
+    '''
+    if filename.endswith(".csv"):
+        fields = list(dict.fromkeys(k for row in rows for k in row))
+        with open(filename, "w", newline="") as report:
+            writer = csv.DictWriter(report, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(filename, "w") as report:
+            json.dump(rows, report, indent=2)
+
+def main():
+    psr = argparse.ArgumentParser()
+    psr.add_argument("-o", "--output", dest="opt", type=str, default=None,
+                     help="report file (.json or .csv)")
+    psr.add_argument("--workdir", dest="workdir", type=str, default=None,
+                     help="directory of the synthetic data, kept after the run")
+    psr.add_argument("--pmts", dest="pmts", type=int, default=synthetic.N,
+                     help="number of PMTs")
+    psr.add_argument("--vertices", dest="vertices", type=int, default=1000,
+                     help="vertices per training file at scale 1")
+    psr.add_argument("--files", dest="files", type=int, default=1,
+                     help="number of training files")
+    psr.add_argument("--test-vertices", dest="test_vertices", type=int, default=200,
+                     help="vertices of the concat file at scale 1")
+    psr.add_argument("--lambda0", dest="lambda0", type=float,
+                     default=synthetic.LAMBDA0,
+                     help="expected PEs per PMT of a vertex at the center")
+    psr.add_argument("--scales", dest="scales", type=int, nargs="+", default=[1],
+                     help="data size multipliers of the scaling curve")
+    psr.add_argument("-b", "--bins", dest="bins", type=int, default=10,
+                     help="r and θ bins")
+    psr.add_argument("-t", "--tbins", dest="tbins", type=int, default=10,
+                     help="t bins")
+    psr.add_argument("--max-memory", dest="max_memory", type=float, default=1024,
+                     help="memory limit of the geometry stage per worker (MB)")
+    psr.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                     help="number of worker processes")
+    psr.add_argument("--memory", dest="memory", action="store_true",
+                     help="trace the peak memory of every stage")
+    args = psr.parse_args()
+
+    rows = []
+    for scale in args.scales:
+        if args.workdir is None:
+            directory = tempfile.mkdtemp(prefix="junoprobe-bench-")
+        else:
+            directory = os.path.join(args.workdir, f"scale{scale}")
+            os.makedirs(directory, exist_ok=True)
+        try:
+            rows.extend(bench(directory, args, scale))
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(directory)
+
+    for row in rows:
+        if "score" in row:
+            print(f"scale {row['scale']}: score {row['score']}, "
+                  f"truth {row['truth_score']}")
+    if args.opt is not None:
+        write_report(args.opt, rows)
+
+if __name__ == "__main__":
+    main()
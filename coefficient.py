@@ -1,15 +1,285 @@
 import numpy as np
 import h5py as h5
 from abc import ABCMeta, abstractmethod
+from functools import cached_property
+from multiprocessing import Pool
+import math
+import os
+import threading
 import time
+import profiling
 
 TMAX = 1000
+# The number of PEs or vertices scored at a time.
+CHUNK = 2**20
+# The seed of the vertex sample of `ProbeBase.is_consistent`, when it samples.
+CHECK_SEED = 0
+# The absolute tolerance of `ProbeBase.is_log_consistent`, above the rounding
+# of float32 tables.
+LOG_ATOL = 1e-5
+# The cell size of `SpatialIndex` on the (r cos(theta), r sin(theta)) half plane.
+INDEX_CELL = 1 / 32
+# The format version of the index file written next to a concat file.
+INDEX_VERSION = 1
+# The format version of the statistics files written next to a concat file.
+STATISTICS_VERSION = 1
+# The default cells of the reference grid of `SufficientStatistics` in
+# r**3, 1 - cos(theta) and t. Their divisors include the usual bin counts.
+STATISTICS_GRID = (120, 120, 1000)
+
+
+def check_indices(n, size=None, seed=CHECK_SEED):
+    """Choose the vertices checked by `ProbeBase.is_consistent`.
+
+    Parameters
+    ----------
+    n : int
+        The number of vertices.
+    size : int or None
+        The number of vertices to check. `None` checks all of them.
+    seed : int
+        The seed of the sample.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted indices of the vertices.
+    """
+    if size is None or size >= n:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(seed).choice(n, size=size, replace=False))
+
+
+def digitize(values, edges):
+    """Find the bins of `values` as `numpy.histogram` does.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The values to bin.
+    edges : numpy.ndarray
+        Increasing bin edges. The last bin includes its right edge.
+
+    Returns
+    -------
+    numpy.ndarray
+        The bin index of each value, -1 outside of the edges.
+    """
+    idx = np.searchsorted(edges, values, side="right") - 1
+    idx[values == edges[-1]] = len(edges) - 2
+    idx[(idx < 0) | (idx >= len(edges) - 1)] = -1
+    return idx
+
+
+def write_keyed(filename, key, datasets, compression=None):
+    """Write `datasets` and their `key` to `filename` through a temporary file.
+
+    Readers never see a partial file. An unwritable location is ignored, it
+    only costs rebuilding the data next time.
+
+    Parameters
+    ----------
+    filename : str
+        The file to write.
+    key : tuple
+        Identifies what the data was built from, stored as the ``Key`` attr.
+    datasets : dict
+        `numpy.ndarray` by dataset path.
+    compression : str or None
+        The compression of the datasets.
+    """
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with h5.File(tmp, "w") as file:
+            file.attrs["Key"] = key
+            for name, data in datasets.items():
+                file.create_dataset(name, data=data, compression=compression)
+        os.replace(tmp, filename)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class SpatialIndex:
+    """Grid buckets of points on the (r cos(theta), r sin(theta)) half plane.
+
+    The plane :math:`[-1, 1] \\times [0, 1]` is divided into square cells of
+    side `INDEX_CELL`, numbered row by row. `order` lists the points cell
+    by cell, and the points of cell `k` are ``order[start[k]:start[k + 1]]``.
+    A disc then only touches the points of the cells it overlaps.
+    """
+
+    NX = int(round(2 / INDEX_CELL))
+    NY = int(round(1 / INDEX_CELL))
+
+    def __init__(self, order, start):
+        self.order = order
+        self.start = start
+
+    @classmethod
+    def cells(cls, rs, thetas):
+        """The cell number of the points at `rs` and `thetas`."""
+        ix = np.floor((rs * np.cos(thetas) + 1) / INDEX_CELL).astype(np.int64)
+        iy = np.floor(rs * np.sin(thetas) / INDEX_CELL).astype(np.int64)
+        return np.clip(iy, 0, cls.NY - 1) * cls.NX + np.clip(ix, 0, cls.NX - 1)
+
+    @classmethod
+    def build(cls, chunks, n):
+        """Build the index from ``(rs, thetas, ...)`` chunks of `n` points."""
+        cells = np.empty(n, dtype=np.int32)
+        i = 0
+        for rs, thetas, *_ in chunks:
+            cells[i : i + len(rs)] = cls.cells(rs, thetas)
+            i += len(rs)
+        order = np.argsort(cells, kind="stable")
+        order = order.astype(np.uint32 if n < 2**32 else np.int64)
+        start = np.searchsorted(cells[order], np.arange(cls.NX * cls.NY + 1))
+        return cls(order, start)
+
+    def candidates(self, r, theta, radius):
+        """The sorted indices of the points in the cells overlapping a disc.
+
+        Parameters
+        ----------
+        r, theta : float
+            The center of the disc.
+        radius : float
+            The radius of the disc.
+
+        Returns
+        -------
+        numpy.ndarray
+            A superset of the points in the disc, in increasing order.
+        """
+        # 略微扩大外接正方形, 避免格子边界上的舍入误差漏掉圆内的点
+        x, y, pad = r * np.cos(theta), r * np.sin(theta), radius + 1e-9
+        ix0, ix1 = (np.clip(np.floor((np.array([x - pad, x + pad]) + 1) / INDEX_CELL),
+                            0, self.NX - 1).astype(int))
+        iy0, iy1 = np.clip(np.floor(np.array([y - pad, y + pad]) / INDEX_CELL),
+                           0, self.NY - 1).astype(int)
+        # 每一行中相邻的格子在order中也相邻
+        rows = [
+            self.order[self.start[iy * self.NX + ix0] : self.start[iy * self.NX + ix1 + 1]]
+            for iy in range(iy0, iy1 + 1)
+        ]
+        return np.sort(np.concatenate(rows)).astype(np.int64)
+
+
+def coarsen(counts, axis, bins):
+    """Sum the cells of `counts` along `axis` into bins.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        The counts of the cells.
+    axis : int
+        The axis to sum along.
+    bins : numpy.ndarray
+        The bin of every cell along `axis`, from 0 to ``bins.max()``.
+
+    Returns
+    -------
+    numpy.ndarray
+        The counts of the bins, with ``bins.max() + 1`` entries along `axis`.
+    """
+    # 连续的同一格子的元素先一起求和, 再累加到各自的格子
+    start = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    runs = np.moveaxis(np.add.reduceat(counts, start, axis=axis), axis, 0)
+    result = np.zeros((bins.max() + 1,) + runs.shape[1:], dtype=counts.dtype)
+    np.add.at(result, bins[start], runs)
+    return np.moveaxis(result, 0, axis)
+
+
+class SufficientStatistics:
+    """The counts of the PEs and vertices of a concat file on a reference grid.
+
+    The reference grid divides :math:`r^3`, :math:`1 - \\cos\\theta` and
+    :math:`t / T_{MAX}` in [0, 1] into `grid` equal cells each, and the
+    points are assigned to cells as `probe.Table` assigns them to uniform
+    bins: values beyond the ends fall into the first or last cell. For a
+    probe that is constant on groups of cells, the score only depends on the
+    counts of the groups, see `ProbeBase.validate_statistics`.
+    """
+
+    def __init__(self, grid, counts, exposure):
+        self.grid = tuple(int(n) for n in grid)
+        self.counts = counts
+        self.exposure = exposure
+        self._coarse = {}
+
+    @staticmethod
+    def cells(grid, rs, thetas, ts=None):
+        """The flat reference cells of points, without or with :math:`t`."""
+        n_r, n_theta, n_t = grid
+        r_idx = np.clip((rs**3 * n_r).astype(np.int64), 0, n_r - 1)
+        theta_idx = np.clip(((1 - np.cos(thetas)) * n_theta).astype(np.int64), 0, n_theta - 1)
+        flat = r_idx * n_theta + theta_idx
+        if ts is None:
+            return flat
+        ts = np.clip(ts, 0, (1 - 1e-15) * TMAX)
+        return flat * n_t + (ts * n_t / TMAX).astype(np.int64)
+
+    @classmethod
+    def build(cls, concat, grid):
+        """Count the PEs and vertices of a `ConcatInfo`, chunk by chunk."""
+        n_r, n_theta, n_t = grid
+        counts = np.zeros(n_r * n_theta * n_t, dtype=np.int64)
+        exposure = np.zeros(n_r * n_theta, dtype=np.int64)
+        for rs, thetas, ts in concat.iter_pe():
+            counts += np.bincount(cls.cells(grid, rs, thetas, ts), minlength=len(counts))
+        for rs, thetas in concat.iter_vertices():
+            exposure += np.bincount(cls.cells(grid, rs, thetas), minlength=len(exposure))
+        return cls(grid, counts.reshape(n_r, n_theta, n_t), exposure.reshape(n_r, n_theta))
+
+    def compatible(self, cells):
+        """Whether bins of uniform cells `cells` are unions of reference cells."""
+        return cells is not None and all(
+            len(c) > 0 and n % len(c) == 0 for c, n in zip(cells, self.grid)
+        )
+
+    def coarsen(self, cells):
+        """The counts of the bins of a probe.
+
+        Parameters
+        ----------
+        cells : tuple of numpy.ndarray
+            The bins of the uniform cells, as returned by `ProbeBase.get_grid`.
+            Must be `compatible`.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The PE counts of the (r, theta, t) bins, the vertex counts of the
+            (r, theta) bins, and a point in every r, theta and t bin. Bins
+            without any cell are left out. The result is cached per `cells`.
+        """
+        key = tuple(c.tobytes() for c in cells)
+        if key not in self._coarse:
+            counts, exposure, points = self.counts, self.exposure, []
+            for axis, (c, n) in enumerate(zip(cells, self.grid)):
+                _, first, inverse = np.unique(c, return_index=True, return_inverse=True)
+                bins = np.repeat(inverse.ravel(), n // len(c))
+                counts = coarsen(counts, axis, bins)
+                if axis < 2:
+                    exposure = coarsen(exposure, axis, bins)
+                points.append((first + 0.5) / len(c))
+            x_r, x_theta, x_t = points
+            self._coarse[key] = (
+                counts,
+                exposure,
+                (x_r ** (1 / 3), np.arccos(1 - x_theta), x_t * TMAX),
+            )
+        return self._coarse[key]
+
+
+# The statistics loaded in this process, by (concat file, size, mtime, grid).
+statistics = {}
 
 
 class ConcatInfo:
     """The loader of the concat file."""
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, stream: bool = False):
         """Init ConcatInfo from an HDF5 file.
 
         The concat file concats vertex and PE information.
@@ -19,22 +289,367 @@ class ConcatInfo:
         ----------
         filename : str
             The file path of the concat file.
+        stream : bool
+            Do not load the datasets into memory. Only `iter_pe` and
+            `iter_vertices` are available, which read the file chunk by chunk.
         """
+        self.filename = filename
+        self.stream = stream
+        self.shared = None
         with h5.File(filename, "r", swmr=True) as file:
-            concat = file["Concat"][()]
+            self.n_pe = len(file["Concat"])
+            self.n_v = len(file["Vertices"])
+            if stream:
+                return
+            with profiling.span("concat.read", self.n_pe + self.n_v):
+                concat = file["Concat"][()]
+                vertices = file["Vertices"][()]
             self.pe_rs = concat["r"]
             self.pe_thetas = concat["theta"]
             self.pe_ts = concat["t"]
 
-            self.f_pe_rs = np.hstack([self.pe_rs, self.pe_rs])
-            self.f_pe_thetas = np.hstack([self.pe_thetas, 2 * np.pi - self.pe_thetas])
-            self.f_pe_ts = np.hstack([self.pe_ts, self.pe_ts])
-
-            vertices = file["Vertices"][()]
             self.v_rs = vertices["r"]
             self.v_thetas = vertices["theta"]
-            self.f_v_rs = np.hstack([self.v_rs, self.v_rs])
-            self.f_v_thetas = np.hstack([self.v_thetas, 2 * np.pi - self.v_thetas])
+
+    # The arrays of a loaded concat file, and the datasets and fields they come from.
+    ARRAYS = {
+        "pe_rs": ("Concat", "r"),
+        "pe_thetas": ("Concat", "theta"),
+        "pe_ts": ("Concat", "t"),
+        "v_rs": ("Vertices", "r"),
+        "v_thetas": ("Vertices", "theta"),
+    }
+
+    def share(self, directory: str):
+        """Memory map the arrays from ``.npy`` files in `directory`.
+
+        The files are written chunk by chunk if `directory` does not exist
+        yet, so a streamed `ConcatInfo` is not loaded into memory. Afterwards
+        the arrays are available as if the file was loaded, and pickling only
+        passes `directory`: worker processes map the same pages instead of
+        receiving copies.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the ``.npy`` files.
+
+        Returns
+        -------
+        ConcatInfo
+            self.
+        """
+        if not os.path.isdir(directory):
+            parent = os.path.dirname(os.path.abspath(directory))
+            os.makedirs(parent, exist_ok=True)
+            tmp = f"{directory}.{os.getpid()}.tmp"
+            os.makedirs(tmp, exist_ok=True)
+            for name in ("Concat", "Vertices"):
+                n = self.n_pe if name == "Concat" else self.n_v
+                arrays = {
+                    attr: np.lib.format.open_memmap(
+                        os.path.join(tmp, f"{attr}.npy"), mode="w+", dtype=np.float64, shape=(n,)
+                    )
+                    for attr, (dataset, _) in self.ARRAYS.items()
+                    if dataset == name
+                }
+                fields = tuple(self.ARRAYS[attr][1] for attr in arrays)
+                i = 0
+                for chunk in self._iter(name, fields, n, CHUNK, 0, None):
+                    for array, values in zip(arrays.values(), chunk):
+                        array[i : i + len(values)] = values
+                    i += len(chunk[0])
+                for array in arrays.values():
+                    array.flush()
+            try:
+                os.rename(tmp, directory)
+            except OSError:
+                # another process has written the same directory
+                for attr in self.ARRAYS:
+                    os.remove(os.path.join(tmp, f"{attr}.npy"))
+                os.rmdir(tmp)
+        self.shared = directory
+        self.stream = False
+        self._map()
+        return self
+
+    def _map(self):
+        for attr in self.ARRAYS:
+            self.__dict__[attr] = np.load(
+                os.path.join(self.shared, f"{attr}.npy"), mmap_mode="r"
+            )
+
+    def __getstate__(self):
+        if self.shared is None:
+            return self.__dict__
+        # the arrays, the mirrored arrays and the caches are reopened or rebuilt
+        return {
+            k: v
+            for k, v in self.__dict__.items()
+            if k in ("filename", "stream", "shared", "n_pe", "n_v")
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self._map()
+
+    @cached_property
+    def f_pe_rs(self):
+        return np.hstack([self.pe_rs, self.pe_rs])
+
+    @cached_property
+    def f_pe_thetas(self):
+        return np.hstack([self.pe_thetas, 2 * np.pi - self.pe_thetas])
+
+    @cached_property
+    def f_pe_ts(self):
+        return np.hstack([self.pe_ts, self.pe_ts])
+
+    @cached_property
+    def f_v_rs(self):
+        return np.hstack([self.v_rs, self.v_rs])
+
+    @cached_property
+    def f_v_thetas(self):
+        return np.hstack([self.v_thetas, 2 * np.pi - self.v_thetas])
+
+    def _iter(self, name, fields, n, chunk, start, stop):
+        stop = n if stop is None else stop
+        if not self.stream:
+            arrays = {
+                "Concat": (self.pe_rs, self.pe_thetas, self.pe_ts),
+                "Vertices": (self.v_rs, self.v_thetas),
+            }[name]
+            for i in range(start, stop, chunk):
+                yield tuple(a[i : min(i + chunk, stop)] for a in arrays)
+            return
+        with h5.File(self.filename, "r", swmr=True) as file:
+            dataset = file[name]
+            for i in range(start, stop, chunk):
+                with profiling.span("concat.read", min(i + chunk, stop) - i):
+                    rows = dataset[i : min(i + chunk, stop)]
+                yield tuple(rows[f] for f in fields)
+
+    def iter_pe(self, chunk: int = CHUNK, start: int = 0, stop=None):
+        """Iterate over the PEs in chunks.
+
+        Parameters
+        ----------
+        chunk : int
+            The number of PEs per chunk.
+        start, stop : int
+            The range of PEs to iterate over.
+
+        Yields
+        ------
+        tuple of numpy.ndarray
+            :math:`r`, :math:`\\theta` and :math:`t` of the PEs in a chunk.
+        """
+        return self._iter("Concat", ("r", "theta", "t"), self.n_pe, chunk, start, stop)
+
+    def iter_vertices(self, chunk: int = CHUNK, start: int = 0, stop=None):
+        """Iterate over the vertices in chunks.
+
+        See Also
+        --------
+        iter_pe
+        """
+        return self._iter("Vertices", ("r", "theta"), self.n_v, chunk, start, stop)
+
+    @property
+    def index_filename(self):
+        """The file the spatial index is persisted to."""
+        return f"{self.filename}.index.h5"
+
+    @cached_property
+    def index(self):
+        """The `SpatialIndex` of the PEs and of the vertices.
+
+        The index is read from `index_filename` if it was built from the
+        current concat file, otherwise it is built and written there. An
+        unwritable location only costs rebuilding it next time.
+
+        Returns
+        -------
+        dict
+            `SpatialIndex` by dataset, ``"Concat"`` or ``"Vertices"``.
+        """
+        stat = os.stat(self.filename)
+        key = (INDEX_VERSION, INDEX_CELL, stat.st_size, stat.st_mtime_ns)
+        try:
+            with h5.File(self.index_filename, "r") as file:
+                if tuple(file.attrs["Key"]) == key:
+                    return {
+                        name: SpatialIndex(file[name]["Order"][()], file[name]["Start"][()])
+                        for name in ("Concat", "Vertices")
+                    }
+        except (OSError, KeyError):
+            pass
+
+        with profiling.span("concat.index", self.n_pe + self.n_v):
+            index = {
+                "Concat": SpatialIndex.build(self.iter_pe(), self.n_pe),
+                "Vertices": SpatialIndex.build(self.iter_vertices(), self.n_v),
+            }
+        datasets = {}
+        for name, spatial in index.items():
+            datasets[f"{name}/Order"] = spatial.order
+            datasets[f"{name}/Start"] = spatial.start
+        write_keyed(self.index_filename, key, datasets)
+        return index
+
+    def statistics_filename(self, grid=STATISTICS_GRID):
+        """The file the `SufficientStatistics` on `grid` are persisted to."""
+        return f"{self.filename}.{'x'.join(map(str, grid))}.statistics.h5"
+
+    def statistics(self, grid=STATISTICS_GRID):
+        """The `SufficientStatistics` of the concat file on `grid`.
+
+        They are read from `statistics_filename` if they were built from the
+        current concat file, otherwise they are built and written there, as
+        `index`. Once loaded, they are kept for the process.
+
+        Parameters
+        ----------
+        grid : tuple of int
+            The cells of the reference grid in :math:`r^3`,
+            :math:`1 - \\cos\\theta` and :math:`t`.
+
+        Returns
+        -------
+        SufficientStatistics
+        """
+        grid = tuple(int(n) for n in grid)
+        stat = os.stat(self.filename)
+        key = (STATISTICS_VERSION, stat.st_size, stat.st_mtime_ns) + grid
+        cache_key = (os.path.realpath(self.filename),) + key
+        if cache_key in statistics:
+            return statistics[cache_key]
+        filename = self.statistics_filename(grid)
+        try:
+            with h5.File(filename, "r") as file:
+                if tuple(file.attrs["Key"]) == key:
+                    statistics[cache_key] = SufficientStatistics(
+                        grid, file["Counts"][()], file["Exposure"][()]
+                    )
+                    return statistics[cache_key]
+        except (OSError, KeyError):
+            pass
+
+        with profiling.span("concat.statistics", self.n_pe + self.n_v):
+            result = SufficientStatistics.build(self, grid)
+        write_keyed(
+            filename,
+            key,
+            {"Counts": result.counts, "Exposure": result.exposure},
+            compression="gzip",
+        )
+        statistics[cache_key] = result
+        return result
+
+    def _near(self, name, fields, r, theta, radius):
+        indices = self.index[name].candidates(r, theta, radius)
+        if self.stream:
+            with h5.File(self.filename, "r", swmr=True) as file:
+                rows = file[name][indices]
+            rs, thetas = rows[fields[0]], rows[fields[1]]
+        else:
+            rs, thetas = getattr(self, fields[0])[indices], getattr(self, fields[1])[indices]
+        return indices[
+            rs**2 + r**2 - 2 * rs * r * np.cos(thetas - theta) <= radius**2
+        ]
+
+    def near_pe(self, r, theta, radius):
+        """Find the PEs within `radius` of :math:`(r, \\theta)`.
+
+        Only the PEs in the cells of `index` overlapping the disc are
+        tested, with the same polar distance as a full scan.
+
+        Parameters
+        ----------
+        r, theta : float
+            The center of the neighborhood.
+        radius : float
+            The radius of the neighborhood.
+
+        Returns
+        -------
+        numpy.ndarray
+            The increasing indices of the PEs.
+        """
+        fields = ("r", "theta") if self.stream else ("pe_rs", "pe_thetas")
+        return self._near("Concat", fields, r, theta, radius)
+
+    def near_vertices(self, r, theta, radius):
+        """Find the vertices within `radius` of :math:`(r, \\theta)`.
+
+        See Also
+        --------
+        near_pe
+        """
+        fields = ("r", "theta") if self.stream else ("v_rs", "v_thetas")
+        return self._near("Vertices", fields, r, theta, radius)
+
+    def pie_bins(self, name, r_bins, theta_bins):
+        """Find the (r, theta) bins of the PEs or vertices and of their mirrors.
+
+        The mirror of :math:`(r, \\theta)` is :math:`(r, 2\\pi - \\theta)`,
+        as in `f_pe_thetas` and `f_v_thetas`, but the mirrored arrays are not
+        built. The result is cached per binning.
+
+        Parameters
+        ----------
+        name : str
+            ``"Concat"`` or ``"Vertices"``.
+        r_bins, theta_bins : numpy.ndarray
+            The bin edges, binned as `numpy.histogram2d` does.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The flat bin index ``i_r * (len(theta_bins) - 1) + i_theta`` of
+            the points and of their mirrors, -1 outside of the bins.
+        """
+        key = (name, r_bins.tobytes(), theta_bins.tobytes())
+        cache = self.__dict__.setdefault("_pie_bins", {})
+        if key not in cache:
+            n = self.n_pe if name == "Concat" else self.n_v
+            bins = np.empty(n, dtype=np.int32)
+            mirror = np.empty(n, dtype=np.int32)
+            i = 0
+            for rs, thetas, *_ in self._iter(name, ("r", "theta"), n, CHUNK, 0, None):
+                r_idx = digitize(rs, r_bins)
+                for out, th in ((bins, thetas), (mirror, 2 * np.pi - thetas)):
+                    t_idx = digitize(th, theta_bins)
+                    out[i : i + len(rs)] = np.where(
+                        (r_idx >= 0) & (t_idx >= 0),
+                        r_idx * (len(theta_bins) - 1) + t_idx,
+                        -1,
+                    )
+                i += len(rs)
+            cache[key] = (bins, mirror)
+        return cache[key]
+
+    def sample_vertices(self, indices):
+        """Read the vertices at `indices`.
+
+        Parameters
+        ----------
+        indices : numpy.ndarray
+            The indices of the vertices.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            :math:`r` and :math:`\\theta` of the vertices.
+        """
+        if not self.stream:
+            return self.v_rs[indices], self.v_thetas[indices]
+        unique, inverse = np.unique(indices, return_inverse=True)
+        with h5.File(self.filename, "r", swmr=True) as file:
+            rows = file["Vertices"][unique][inverse]
+        return rows["r"], rows["theta"]
 
 
 class ProbeBase(metaclass=ABCMeta):
@@ -86,6 +701,29 @@ class ProbeBase(metaclass=ABCMeta):
         """
         pass
 
+    def get_log_lc(self, rs, thetas, ts):
+        """Calculate :math:`\\log R(r,\\theta,t)`.
+
+        The default takes the logarithm of `get_lc`. A probe that can
+        evaluate the logarithm directly, e.g. from a precomputed table,
+        may override this to save a pass over the PEs in `validate`.
+
+        Parameters
+        ----------
+        rs : numpy.ndarray
+            Falls in [0, 1].
+        thetas : numpy.ndarray
+            The same shape as `rs`. Falls in [0, :math:`\\pi`]
+        ts : numpy.ndarray
+            The same shape as `rs`.
+
+        Returns
+        -------
+        numpy.ndarray
+            The same shape as `rs`.
+        """
+        return np.log(self.get_lc(rs, thetas, ts))
+
     def get_pie(self, rs, thetas):
         """Generate Pie from giving :math:`r` and :math:`\\theta`.
 
@@ -106,29 +744,175 @@ class ProbeBase(metaclass=ABCMeta):
         thetas2, rs2 = np.meshgrid(thetas, rs)
         return self.get_mu(rs2, thetas2)
 
-    def is_consistent(self, v_rs, v_thetas) -> bool:
-        NV = 100
-        np.random.seed(time.time_ns() % 65536)
-        indices = np.random.choice(len(v_rs), size=NV)
-        rs = v_rs[indices]
-        thetas = v_thetas[indices]
-        marginal = self.get_mu(rs, thetas)
-        NT = 10000
-        ts = np.linspace(0, TMAX, NT + 1)
-        ts = (ts[1:] + ts[:-1]) / 2
-        integral = (
-            np.sum(
-                self.get_lc(
-                    np.tile(rs, (NT, 1)).T,
-                    np.tile(thetas, (NT, 1)).T,
-                    np.tile(ts, (NV, 1)),
-                ),
-                axis=1,
+    def get_time_breakpoints(self):
+        """The times where :math:`R(r,\\theta,t)` may jump, if known.
+
+        A probe that is piecewise constant in :math:`t` may override this,
+        so that `integrate_lc` is exact with one evaluation per piece.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            Increasing times in [0, `TMAX`]. Between two neighbouring
+            breakpoints :math:`R` must not depend on :math:`t` for any
+            :math:`r` and :math:`\\theta`. `None` if unknown.
+        """
+        return None
+
+    def get_grid(self):
+        """The uniform cells the probe is constant on, if known.
+
+        A probe that is piecewise constant on bins made of equal cells in
+        :math:`r^3`, :math:`1 - \\cos\\theta` and :math:`t` may override this,
+        so that `validate_binned` scores it from `SufficientStatistics`.
+
+        Returns
+        -------
+        tuple of numpy.ndarray or None
+            For :math:`r^3`, :math:`1 - \\cos\\theta` and :math:`t / T_{MAX}`,
+            the bin of each of the equal cells dividing [0, 1]. Values beyond
+            the ends must be in the first or last cell, so the probe must be
+            constant for :math:`\\theta > \\pi / 2`. `None` if unknown.
+        """
+        return None
+
+    def get_lc_antiderivative(self, rs, thetas, ts):
+        """Calculate :math:`\\int_0^t R(r,\\theta,t')\\mathrm{d}t'`, if known.
+
+        A probe with a closed-form antiderivative in :math:`t` may override
+        this, so that `integrate_lc` is exact.
+
+        Parameters
+        ----------
+        rs : numpy.ndarray
+            Falls in [0, 1].
+        thetas : numpy.ndarray
+            The same shape as `rs`. Falls in [0, :math:`\\pi`]
+        ts : numpy.ndarray
+            The same shape as `rs`.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            The same shape as `rs`. `None` if unknown.
+        """
+        return None
+
+    def integrate_lc(self, rs, thetas):
+        """Integrate :math:`R(r,\\theta,t)` over :math:`t` in [0, `TMAX`].
+
+        Uses `get_time_breakpoints` or `get_lc_antiderivative` when the probe
+        provides them. Otherwise the midpoint rule is applied on a grid that
+        doubles from 1000 to 16000 nodes until two successive results agree.
+
+        Parameters
+        ----------
+        rs : numpy.ndarray
+            1-d, falls in [0, 1].
+        thetas : numpy.ndarray
+            The same shape as `rs`. Falls in [0, :math:`\\pi`]
+
+        Returns
+        -------
+        numpy.ndarray
+            The same shape as `rs`.
+        """
+        breakpoints = self.get_time_breakpoints()
+        if breakpoints is not None:
+            breakpoints = np.unique(np.clip(np.r_[0, breakpoints, TMAX], 0, TMAX))
+            integral = np.zeros(len(rs))
+            for t0, t1 in zip(breakpoints[:-1], breakpoints[1:]):
+                ts = np.full(len(rs), (t0 + t1) / 2)
+                integral += self.get_lc(rs, thetas, ts) * (t1 - t0)
+            return integral
+
+        upper = self.get_lc_antiderivative(rs, thetas, np.full(len(rs), TMAX))
+        if upper is not None:
+            return upper - self.get_lc_antiderivative(rs, thetas, np.zeros(len(rs)))
+
+        previous = None
+        for NT in 1000 * 2 ** np.arange(5):
+            ts = (np.arange(NT) + 0.5) * TMAX / NT
+            block = max(CHUNK // NT, 1)
+            integral = np.concatenate(
+                [
+                    np.sum(
+                        self.get_lc(
+                            np.repeat(rs[i : i + block, None], NT, axis=1),
+                            np.repeat(thetas[i : i + block, None], NT, axis=1),
+                            np.broadcast_to(ts, (len(rs[i : i + block]), NT)),
+                        ),
+                        axis=1,
+                    )
+                    for i in range(0, len(rs), block)
+                ]
+            ) * (TMAX / NT)
+            if previous is not None and np.allclose(previous, integral, rtol=1e-7):
+                break
+            previous = integral
+        return integral
+
+    def is_consistent(self, v_rs, v_thetas, size=None, seed=CHECK_SEED) -> bool:
+        """Check that `get_mu` is the time integral of `get_lc`.
+
+        Every vertex is checked, `CHUNK` at a time, unless `size` asks for a
+        sample.
+
+        Parameters
+        ----------
+        v_rs : numpy.ndarray
+            The :math:`r` of vertices. falls in [0, 1].
+        v_thetas : numpy.ndarray
+            The :math:`\\theta` of vertices.
+        size : int or None
+            The number of vertices to sample. `None` checks all of them.
+        seed : int
+            The seed of the vertex sample, so the check is reproducible.
+
+        Returns
+        -------
+        bool
+        """
+        indices = check_indices(len(v_rs), size, seed)
+        rs = np.ravel(v_rs)[indices]
+        thetas = np.ravel(v_thetas)[indices]
+        with profiling.span("score.is_consistent", len(indices)):
+            return all(
+                np.allclose(
+                    self.get_mu(rs[i : i + CHUNK], thetas[i : i + CHUNK]),
+                    self.integrate_lc(rs[i : i + CHUNK], thetas[i : i + CHUNK]),
+                )
+                for i in range(0, len(rs), CHUNK)
             )
-            * TMAX
-            / NT
-        )
-        return np.allclose(marginal, integral)
+
+    def is_log_consistent(self, pe_rs, pe_thetas, pe_ts) -> bool:
+        """Check that `get_log_lc` is the logarithm of `get_lc`.
+
+        The score sums `get_log_lc`, so a probe overriding it, or a table
+        with a stale ``LogProbe``, is checked on every PE it is scored on.
+
+        Parameters
+        ----------
+        pe_rs : numpy.ndarray
+            The :math:`r` of PEs. falls in [0, 1].
+        pe_thetas : numpy.ndarray
+            The :math:`\\theta` of PEs.
+        pe_ts : numpy.ndarray
+            The time of PEs.
+
+        Returns
+        -------
+        bool
+        """
+        for i in range(0, len(pe_rs), CHUNK):
+            chunk = (pe_rs[i : i + CHUNK], pe_thetas[i : i + CHUNK], pe_ts[i : i + CHUNK])
+            with profiling.span("score.is_log_consistent", len(chunk[0])):
+                log_lc = np.asarray(self.get_log_lc(*chunk), dtype=np.float64)
+                with np.errstate(divide="ignore"):
+                    lc = np.log(np.asarray(self.get_lc(*chunk), dtype=np.float64))
+                if not np.allclose(log_lc, lc, atol=LOG_ATOL):
+                    return False
+        return True
 
     def validate(self, v_rs, v_thetas, pe_rs, pe_thetas, pe_ts):
         """Score a Probe.
@@ -152,14 +936,185 @@ class ProbeBase(metaclass=ABCMeta):
             score.
         """
         assert self.is_consistent(v_rs, v_thetas)
+        assert self.is_log_consistent(pe_rs, pe_thetas, pe_ts)
+
+        nonhit = math.fsum(
+            self.sum_mu(v_rs[i : i + CHUNK], v_thetas[i : i + CHUNK])
+            for i in range(0, len(v_rs), CHUNK)
+        )
+        hit = math.fsum(
+            self.sum_log_lc(
+                pe_rs[i : i + CHUNK], pe_thetas[i : i + CHUNK], pe_ts[i : i + CHUNK]
+            )
+            for i in range(0, len(pe_rs), CHUNK)
+        )
+        return hit - nonhit
+
+    def validate_concat(self, concat: ConcatInfo, jobs: int = 1, check_size=None):
+        """Score a Probe on a concat file, chunk by chunk.
+
+        The memory usage is bounded by `CHUNK` whether `concat` is loaded or
+        streamed. The score is identical to `validate`: both sum every chunk
+        of `CHUNK` items with `numpy.sum`, and the chunks with `math.fsum`.
+        Every chunk of vertices is checked by `is_consistent` where it is
+        scored, unless `check_size` asks for a sample instead. Every chunk of
+        PEs is checked by `is_log_consistent`.
+
+        Parameters
+        ----------
+        concat : ConcatInfo
+            The concat file.
+        jobs : int
+            The number of worker processes. Each worker reads its chunks
+            from ``concat.filename``, so the score does not depend on `jobs`.
+        check_size : int or None
+            The number of vertices to sample for `is_consistent`. `None`
+            checks all of them.
+
+        Returns
+        -------
+        float
+            score.
+        """
+        check = check_size is None
+        if not check:
+            indices = check_indices(concat.n_v, check_size)
+            assert self.is_consistent(*concat.sample_vertices(indices))
+
+        if jobs > 1:
+            v_tasks = [
+                (self, concat.filename, "Vertices", i, min(i + CHUNK, concat.n_v), check)
+                for i in range(0, concat.n_v, CHUNK)
+            ]
+            pe_tasks = [
+                (self, concat.filename, "Concat", i, min(i + CHUNK, concat.n_pe), True)
+                for i in range(0, concat.n_pe, CHUNK)
+            ]
+            with Pool(processes=jobs) as pool:
+                parts = pool.map(
+                    profiling.Traced(score_chunk), v_tasks + pe_tasks, chunksize=1
+                )
+            parts = [profiling.unpack(part) for part in parts]
+            nonhit = math.fsum(parts[: len(v_tasks)])
+            hit = math.fsum(parts[len(v_tasks) :])
+            return hit - nonhit
 
-        nonhit = np.sum(self.get_mu(v_rs, v_thetas))
-        if self.get_mu(v_rs, v_thetas).shape != v_rs.shape:
-            raise ValueError("Arrays v_rs and mu have different shapes.")
+        def sum_mu(v_rs, v_thetas):
+            assert not check or self.is_consistent(v_rs, v_thetas)
+            return self.sum_mu(v_rs, v_thetas)
 
-        hit = self.get_lc(pe_rs, pe_thetas, pe_ts)
-        if hit.shape != pe_rs.shape:
-            raise ValueError("Arrays pe_rs and lc have different shapes.")
+        def sum_log_lc(pe_rs, pe_thetas, pe_ts):
+            assert self.is_log_consistent(pe_rs, pe_thetas, pe_ts)
+            return self.sum_log_lc(pe_rs, pe_thetas, pe_ts)
 
-        hit = np.sum(np.log(hit))
+        nonhit = math.fsum(sum_mu(*v) for v in concat.iter_vertices())
+        hit = math.fsum(sum_log_lc(*pe) for pe in concat.iter_pe())
         return hit - nonhit
+
+    def validate_binned(self, concat: ConcatInfo, grid=STATISTICS_GRID, jobs: int = 1):
+        """Score a Probe on a concat file from its counts when possible.
+
+        Falls back to `validate_concat` unless the probe declares bins by
+        `get_grid` that are unions of the cells of `grid`.
+
+        Parameters
+        ----------
+        concat : ConcatInfo
+            The concat file.
+        grid : tuple of int
+            The reference grid of `ConcatInfo.statistics`.
+        jobs : int
+            The number of worker processes of the fallback.
+
+        Returns
+        -------
+        float
+            score.
+        """
+        cells = self.get_grid()
+        if cells is None or not all(n % len(c) == 0 for c, n in zip(cells, grid)):
+            return self.validate_concat(concat, jobs)
+        return self.validate_statistics(concat.statistics(grid), cells)
+
+    def validate_statistics(self, statistics: SufficientStatistics, cells):
+        """Score a piecewise constant Probe from the counts of its bins.
+
+        For a probe constant on every bin, the score is
+        :math:`\\sum n \\log R - \\sum m R`, where :math:`n` and :math:`m` are
+        the PE and vertex counts of the bins. `R` is evaluated once per bin,
+        and `get_mu` is checked against `integrate_lc` in every bin. Up to
+        rounding, the score equals `validate_concat`.
+
+        Parameters
+        ----------
+        statistics : SufficientStatistics
+            The counts on a reference grid compatible with `cells`.
+        cells : tuple of numpy.ndarray
+            The bins of the probe, see `get_grid`.
+
+        Returns
+        -------
+        float
+            score.
+        """
+        if not statistics.compatible(cells):
+            raise ValueError(f"bins are not unions of the cells of {statistics.grid}")
+        counts, exposure, (rs, thetas, ts) = statistics.coarsen(cells)
+        with profiling.span("score.statistics", counts.size):
+            v_rs, v_thetas = (a.ravel() for a in np.meshgrid(rs, thetas, indexing="ij"))
+            mu = self.get_mu(v_rs, v_thetas)
+            assert np.allclose(mu, self.integrate_lc(v_rs, v_thetas))
+            pe_rs, pe_thetas, pe_ts = (
+                a.ravel() for a in np.meshgrid(rs, thetas, ts, indexing="ij")
+            )
+            hit = counts.ravel() > 0
+            log_lc = self.get_log_lc(pe_rs[hit], pe_thetas[hit], pe_ts[hit])
+            assert self.is_log_consistent(pe_rs[hit], pe_thetas[hit], pe_ts[hit])
+            # 没有PE的格子不计入, 即使其中log R为-inf
+            return math.fsum(counts.ravel()[hit] * log_lc.astype(np.float64)) - math.fsum(
+                exposure.ravel() * mu.astype(np.float64)
+            )
+
+    def sum_mu(self, v_rs, v_thetas):
+        """Sum :math:`R(r,\\theta)` of a chunk of vertices in float64."""
+        with profiling.span("score.mu", len(v_rs)):
+            mu = self.get_mu(v_rs, v_thetas)
+            if mu.shape != v_rs.shape:
+                raise ValueError("Arrays v_rs and mu have different shapes.")
+            return float(np.sum(mu, dtype=np.float64))
+
+    def sum_log_lc(self, pe_rs, pe_thetas, pe_ts):
+        """Sum :math:`\\log R(r,\\theta,t)` of a chunk of PEs in float64."""
+        with profiling.span("score.log_lc", len(pe_rs)):
+            hit = self.get_log_lc(pe_rs, pe_thetas, pe_ts)
+            if hit.shape != pe_rs.shape:
+                raise ValueError("Arrays pe_rs and lc have different shapes.")
+            return float(np.sum(hit, dtype=np.float64))
+
+
+def score_chunk(task):
+    """Score one chunk of a concat file in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        ``(probe, filename, kind, start, stop, check)``, where `kind` is
+        ``"Vertices"`` or ``"Concat"``. With `check`, the vertices are also
+        checked by `ProbeBase.is_consistent`, and the PEs by
+        `ProbeBase.is_log_consistent`.
+
+    Returns
+    -------
+    float
+        :math:`\\sum R(r,\\theta)` of the vertices or
+        :math:`\\sum \\log R(r,\\theta,t)` of the PEs in the chunk.
+    """
+    probe, filename, kind, start, stop, check = task
+    concat = ConcatInfo(filename, stream=True)
+    if kind == "Vertices":
+        (chunk,) = concat.iter_vertices(start=start, stop=stop)
+        assert not check or probe.is_consistent(*chunk)
+        return probe.sum_mu(*chunk)
+    (chunk,) = concat.iter_pe(start=start, stop=stop)
+    assert not check or probe.is_log_consistent(*chunk)
+    return probe.sum_log_lc(*chunk)
@@ -4,11 +4,14 @@ from matplotlib.colors import LogNorm
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
-import multiprocessing.dummy as mp
+from multiprocessing import Pool
+import hashlib
 from coefficient import *
-from probe import Probe
-from scipy import stats
+from probe import HISTOGRAM, HISTOGRAM_ENV
+from score import get_probe, validate
 import os
+import sys
+import profiling
 
 matplotlib.use("agg")
 
@@ -41,23 +44,46 @@ hist_rths = np.array(
 
 neighborhood_r = 0.05
 
+# The format version of the panel data cached by ``draw.py draw``.
+DRAW_CACHE_VERSION = 1
 
-def draw_pie(probe: ProbeBase, fig, ax):
-    """Draw the Probe pie.
+
+def pie_data(probe: ProbeBase):
+    """Calculate the Probe pie.
 
     We split the bins uniformly, and take the medium value from the bins,
     for the input :math:`r` and :math:`\\theta`.
 
+    Returns
+    -------
+    dict
+        The bin centers ``r`` and ``theta``, and :math:`R(r,\\theta)` as ``mu``.
     """
     r_bins = np.linspace(0, 1, 51)
     theta_bins = np.linspace(0, 2 * np.pi, 201)
     r_mid = (r_bins[1:] + r_bins[:-1]) / 2
     theta_mid = (theta_bins[1:] + theta_bins[:-1]) / 2
-    ss = probe.get_pie(r_mid, theta_mid)
-    m = ax.pcolormesh(theta_mid, r_mid, ss, norm=LogNorm(), cmap="jet")
+    with profiling.span("draw.pie", len(r_mid) * len(theta_mid)):
+        ss = probe.get_pie(r_mid, theta_mid)
+    return {"r": r_mid, "theta": theta_mid, "mu": ss}
+
+
+def render_pie(data, fig, ax):
+    """Draw the data of `pie_data`."""
+    m = ax.pcolormesh(data["theta"], data["r"], data["mu"], norm=LogNorm(), cmap="jet")
     fig.colorbar(m)
 
 
+def draw_pie(probe: ProbeBase, fig, ax):
+    """Draw the Probe pie.
+
+    See Also
+    --------
+    pie_data : Calculate the probe pie
+    """
+    render_pie(pie_data(probe), fig, ax)
+
+
 def draw_neighborhood(fig, ax):
     """Draw the neighborhoods.
 
@@ -74,8 +100,8 @@ def draw_neighborhood(fig, ax):
     )
 
 
-def draw_time_hist(probe: ProbeBase, c: ConcatInfo, r, theta, fig, ax):
-    """Draw :math:`R(t)`, together with the real histogram.
+def time_hist_data(probe: ProbeBase, c: ConcatInfo, r, theta):
+    """Calculate :math:`R(t)`, together with the real histogram.
 
     .. math:: R(t)=\\frac{1}{n}\sum_{v \in \\textrm{nearby vertices}}R(r_v,\\theta_v,t)
 
@@ -83,105 +109,305 @@ def draw_time_hist(probe: ProbeBase, c: ConcatInfo, r, theta, fig, ax):
 
     The real histogram is a histogram of time of all nearby vertices-induced PEs,
     divided by :math:`n`.
+
+    The nearby PEs and vertices are queried from the spatial index of `c`.
+
+    Returns
+    -------
+    dict
+        :math:`R(t)` as ``ts`` and ``lc``, the histogram as ``edges`` and
+        ``hist``, and :math:`n` as ``n_v``.
     """
-    sts = c.pe_ts[
-        c.pe_rs**2 + r**2 - 2 * c.pe_rs * r * np.cos(c.pe_thetas - theta)
-        <= neighborhood_r**2
-    ]
-    svf = (
-        c.v_rs**2 + r**2 - 2 * c.v_rs * r * np.cos(c.v_thetas - theta)
-        <= neighborhood_r**2
-    )
-    ts = np.linspace(0, 1000, num=10001)
-    n_ts = len(ts)
-    ss = probe.get_lc(np.repeat(r, n_ts), np.repeat(theta, n_ts), ts) / n_ts
-    ax.plot(ts, ss, label="R(t)")
-    n_v = np.count_nonzero(svf)
-    if n_v != 0:
-        time_range = (0, 1000)
-        bins = 100
+    with profiling.span("draw.time_hist", c.n_pe + c.n_v):
+        sts = c.pe_ts[c.near_pe(r, theta, neighborhood_r)]
+        n_v = len(c.near_vertices(r, theta, neighborhood_r))
+        ts = np.linspace(0, 1000, num=10001)
+        n_ts = len(ts)
+        ss = probe.get_lc(np.repeat(r, n_ts), np.repeat(theta, n_ts), ts) / n_ts
+        hist, edges = np.histogram(
+            sts, range=(0, 1000), bins=100, weights=np.repeat(1.0 / max(n_v, 1), len(sts))
+        )
+    return {"ts": ts, "lc": ss, "edges": edges, "hist": hist, "n_v": n_v}
+
+
+def render_time_hist(data, fig, ax):
+    """Draw the data of `time_hist_data`."""
+    ax.plot(data["ts"], data["lc"], label="R(t)")
+    if data["n_v"] != 0:
         ax.hist(
-            sts,
-            range=time_range,
-            bins=bins,
-            weights=np.repeat(1.0 / n_v, len(sts)),
+            data["edges"][:-1],
+            bins=data["edges"],
+            weights=data["hist"],
             label="histogram",
         )
 
 
-def verf(probe: ProbeBase, c: ConcatInfo, fig, ax):
-    """Draw the quotient.
+def draw_time_hist(probe: ProbeBase, c: ConcatInfo, r, theta, fig, ax):
+    """Draw :math:`R(t)`, together with the real histogram.
+
+    See Also
+    --------
+    time_hist_data : Calculate :math:`R(t)` and the real histogram
+    """
+    render_time_hist(time_hist_data(probe, c, r, theta), fig, ax)
+
+
+def verf_data(probe: ProbeBase, c: ConcatInfo):
+    """Calculate the quotient.
 
     The quotient is defined as real/probe.
 
+    Returns
+    -------
+    dict
+        The bin edges ``r`` and ``theta``, and the quotient as ``ratio``.
+
     See Also
     --------
-    draw_pie : Calculate the probe pie
-    real_pie : Calculate the real pie
+    pie_data : Calculate the probe pie
+    real_pie_data : Calculate the real pie
     """
     N_r = int(51)
     N_θ = int(201)
     binr = np.linspace(0, 1, N_r)
     binθ = np.linspace(0, 2 * np.pi, N_θ)
-    Binning = [binr, binθ]
 
-    # to return the index of each element in 2-d histogram
-    ret = stats.binned_statistic_2d(
-        c.f_v_rs, c.f_v_thetas, None, "count", bins=Binning, expand_binnumbers=True
-    )
-    r_idx, t_idx = ret.binnumber
-    # initial amplititude
-    Amp = probe.get_mu(c.f_v_rs, c.f_v_thetas)
-    # sum up the amplititude with the 2-d indices
-    Amplitude, _, _ = np.histogram2d(
-        r_idx,
-        t_idx,
-        bins=(np.arange(N_r) + 0.5, np.arange(N_θ) + 0.5),
-        weights=Amp,
-    )
+    with profiling.span("draw.quotient", c.n_pe + c.n_v):
+        # the 2-d bin of each vertex and of its mirror
+        v_bins, v_mirror = c.pie_bins("Vertices", binr, binθ)
+        # sum up the amplititude of the vertices and their mirrors in each bin
+        Amplitude = np.zeros((N_r - 1) * (N_θ - 1))
+        for i in range(0, c.n_v, CHUNK):
+            rs, thetas = c.v_rs[i : i + CHUNK], c.v_thetas[i : i + CHUNK]
+            for bins, ths in ((v_bins, thetas), (v_mirror, 2 * np.pi - thetas)):
+                b = bins[i : i + CHUNK]
+                Amplitude += np.bincount(
+                    b[b >= 0],
+                    weights=probe.get_mu(rs, ths)[b >= 0],
+                    minlength=len(Amplitude),
+                )
+        Amplitude = Amplitude.reshape(N_r - 1, N_θ - 1)
+
+        hist_PE = pie_counts(c, "Concat", binr, binθ)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = hist_PE / Amplitude
+    return {"r": binr, "theta": binθ, "ratio": ratio}
 
-    hist_PE, _, _ = np.histogram2d(c.f_pe_rs, c.f_pe_thetas, bins=Binning)
 
-    X, Y = np.meshgrid(binθ, binr)
-    cm = ax.pcolormesh(X, Y, hist_PE / Amplitude, norm=LogNorm(), cmap="jet")
+def render_ratio(data, fig, ax):
+    """Draw the data of `verf_data` or `real_pie_data`."""
+    X, Y = np.meshgrid(data["theta"], data["r"])
+    cm = ax.pcolormesh(X, Y, data["ratio"], norm=LogNorm(), cmap="jet")
     fig.colorbar(cm)
 
 
-def real_pie(c: ConcatInfo, fig, ax):
-    """Draw the real pie
+def verf(probe: ProbeBase, c: ConcatInfo, fig, ax):
+    """Draw the quotient.
+
+    See Also
+    --------
+    verf_data : Calculate the quotient
+    """
+    render_ratio(verf_data(probe, c), fig, ax)
+
+
+def pie_counts(c: ConcatInfo, name, r_bins, theta_bins):
+    """Histogram the PEs or vertices of `c` and their mirrors.
+
+    The same as `numpy.histogram2d` of the mirrored arrays, e.g.
+    ``c.f_pe_rs`` and ``c.f_pe_thetas``, from the cached bins of `c`.
+
+    See Also
+    --------
+    coefficient.ConcatInfo.pie_bins
+    """
+    n = (len(r_bins) - 1) * (len(theta_bins) - 1)
+    counts = sum(
+        np.bincount(bins[bins >= 0], minlength=n)
+        for bins in c.pie_bins(name, r_bins, theta_bins)
+    )
+    return counts.reshape(len(r_bins) - 1, len(theta_bins) - 1).astype(np.float64)
+
+
+def real_pie_data(c: ConcatInfo):
+    """Calculate the real pie
 
     The pe histogram is renormalized by vertex histogram.
+
+    Returns
+    -------
+    dict
+        The bin edges ``r`` and ``theta``, and the real pie as ``ratio``.
     """
     r_bins = np.linspace(0, 1, 51)
     theta_bins = np.linspace(0, 2 * np.pi, 201)
     Binning = [r_bins, theta_bins]
-    hist_PE, binr, binθ = np.histogram2d(c.f_pe_rs, c.f_pe_thetas, bins=Binning)
-    hist_predict, _, _ = np.histogram2d(c.f_v_rs, c.f_v_thetas, bins=Binning)
-
-    X, Y = np.meshgrid(binθ, binr)
-    cm = ax.pcolormesh(X, Y, hist_PE / hist_predict, norm=LogNorm(), cmap="jet")
-    fig.colorbar(cm)
+    binr, binθ = Binning
+    with profiling.span("draw.real_pie", c.n_pe + c.n_v):
+        hist_PE = pie_counts(c, "Concat", binr, binθ)
+        hist_predict = pie_counts(c, "Vertices", binr, binθ)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = hist_PE / hist_predict
+    return {"r": binr, "theta": binθ, "ratio": ratio}
 
 
-def Validate(probe: ProbeBase, c: ConcatInfo):
-    """Calculate if the Probe is valid.
+def real_pie(c: ConcatInfo, fig, ax):
+    """Draw the real pie
 
     See Also
     --------
-    coefficient.ProbeBase.validate
-    coefficient.ConcatInfo
+    real_pie_data : Calculate the real pie
+    """
+    render_ratio(real_pie_data(c), fig, ax)
+
+
+def file_key(filename):
+    """Identify the content of `filename` by its path, size and modification time."""
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def code_key(probe):
+    """Identify the code of `probe` by the sources of the modules of its classes,
+    and its table dtype."""
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted({cls.__module__ for cls in type(probe).__mro__} - {"builtins", "abc"}):
+        with open(sys.modules[name].__file__, "rb") as source:
+            h.update(source.read())
+    return (type(probe).__qualname__, h.hexdigest(), np.dtype(getattr(probe, "dtype", np.float64)).name)
+
+
+def panel_tasks(histogram, concat, probe):
+    """List the panels of ``draw.py draw``, in page order.
+
+    Parameters
+    ----------
+    histogram : str
+        The probe file.
+    concat : str
+        The concat file.
+    probe : ProbeBase
+        The probe of `histogram`, so that editing its code or changing its
+        dtype invalidates the probe panels.
+
+    Returns
+    -------
+    list of tuple
+        ``(kind, key, parameters, text)`` of each panel. The `key` identifies
+        the data of the panel by the files and the code it depends on and its
+        parameters. `text` is the :math:`\\theta` of a ``"time"`` panel in the
+        title.
     """
-    return probe.validate(c.v_rs, c.v_thetas, c.pe_rs, c.pe_thetas, c.pe_ts)
+    probe_key = (file_key(histogram), code_key(probe))
+    concat_key = file_key(concat)
+    tasks = [
+        ("pie", (probe_key,), (), ""),
+        ("real_pie", (concat_key,), (), ""),
+        ("quotient", (probe_key, concat_key), (), ""),
+    ]
+    tasks.extend(
+        ("time", (probe_key, concat_key), (float(r), float(theta)), theta_text)
+        for r, theta, theta_text in hist_rths
+    )
+    return [
+        (kind, repr((DRAW_CACHE_VERSION, kind, deps, params)), params, text)
+        for kind, deps, params, text in tasks
+    ]
+
+
+def digest(key):
+    """Hash a cache key into a file name."""
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
 
+def panel_filename(cache, kind, key):
+    """The file caching the data of a panel."""
+    return os.path.join(cache, f"{kind}-{digest(key)}.npz")
 
-def get_probe() -> ProbeBase:
-    """Detemine the right probe from the coefficients.
+
+def compute_panel(task):
+    """Calculate the data of a panel in a worker process and cache it.
+
+    Parameters
+    ----------
+    task : tuple
+        ``(kind, filename, probe, concat, parameters)``, where `filename`
+        is the cache file to write.
+
+    Returns
+    -------
+    str
+        `filename`.
+    """
+    kind, filename, probe, concat, params = task
+    if kind == "pie":
+        data = pie_data(probe)
+    elif kind == "real_pie":
+        data = real_pie_data(concat)
+    elif kind == "quotient":
+        data = verf_data(probe, concat)
+    else:
+        data = time_hist_data(probe, concat, *params)
+    tmp = f"{filename}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, **data)
+    os.replace(tmp, filename)
+    return filename
+
+
+def render_page(kind, data, params, text):
+    """Draw the figure of a panel from its data.
+
+    Parameters
+    ----------
+    kind : str
+        ``"pie"``, ``"real_pie"``, ``"quotient"`` or ``"time"``.
+    data : dict
+        The data from `compute_panel`.
+    params : tuple
+        :math:`(r, \\theta)` of a ``"time"`` panel.
+    text : str
+        :math:`\\theta` of a ``"time"`` panel in the title.
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+    """
+    fig = plt.figure()
+    if kind == "time":
+        r, theta = params
+        ax = fig.add_subplot(1, 1, 1)
+        render_time_hist(data, fig, ax)
+        ax.legend()
+        ax.set_xlabel("t/ns")
+        ax.set_title(f"Time r={r} $\\theta$={text}")
+        return fig
+    ax = fig.add_subplot(1, 1, 1, projection="polar", theta_offset=math.pi / 2)
+    if kind == "pie":
+        render_pie(data, fig, ax)
+        ax.set_title(f"Pie")
+    elif kind == "real_pie":
+        render_ratio(data, fig, ax)
+        draw_neighborhood(fig, ax)
+        ax.set_title(f"RealPie")
+    else:
+        render_ratio(data, fig, ax)
+        ax.set_title(f"Quotient")
+    return fig
+
+
+def Validate(probe: ProbeBase, c: ConcatInfo, jobs=1, grid=None):
+    """Calculate if the Probe is valid.
+
+    The score does not depend on `jobs`. With a `grid`, a piecewise constant
+    probe is scored from the counts of the concat file on that grid.
 
     See Also
     --------
-    coefficient.ProbeBase
+    coefficient.ProbeBase.validate_concat
+    coefficient.ProbeBase.validate_binned
+    coefficient.ConcatInfo
     """
-    return Probe()
+    return validate(probe, c, jobs, grid is not None, grid)
 
 
 if __name__ == "__main__":
@@ -191,74 +417,79 @@ if __name__ == "__main__":
     psr.add_argument("command", type=str, help="command")
     psr.add_argument("--concat", dest="concat", type=str, help="concat file")
     psr.add_argument("-o", "--output", dest="opt", type=str, help="output file")
+    psr.add_argument("--histogram", dest="histogram", type=str, help="histogram file")
+    psr.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1, help="number of processes"
+    )
+    psr.add_argument(
+        "--cache", dest="cache", type=str, default="draw_cache", help="panel data cache"
+    )
+    psr.add_argument(
+        "--binned",
+        dest="binned",
+        action="store_true",
+        help="score piecewise constant probes from pre-binned counts",
+    )
+    psr.add_argument(
+        "--grid",
+        dest="grid",
+        type=int,
+        nargs=3,
+        default=STATISTICS_GRID,
+        help="cells of the pre-binned counts in r^3, 1-cos(theta) and t",
+    )
+    psr.add_argument(
+        "--profile", dest="profile", type=str, help="stage timing report (.json or .csv)"
+    )
+    psr.add_argument(
+        "--profile-stage", dest="profile_stage", type=str, help="stage to run under cProfile"
+    )
     args = psr.parse_args()
+    if args.profile is not None:
+        profiling.enable(args.profile, args.profile_stage)
 
     if args.command == "draw":
-        concat = ConcatInfo(args.concat)
-
-        def draw_log_pie_fig(probe: ProbeBase):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1, projection="polar", theta_offset=math.pi / 2)
-            draw_pie(probe, fig, ax)
-            ax.set_title(f"Pie")
-            print("Pie done")
-            return fig
-
-        def draw_real_pie_fig(concat: ConcatInfo):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1, projection="polar", theta_offset=math.pi / 2)
-            real_pie(concat, fig, ax)
-            draw_neighborhood(fig, ax)
-            ax.set_title(f"RealPie")
-            print("RealPie done")
-            return fig
-
-        def draw_quotient_fig(probe: ProbeBase, concat: ConcatInfo):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1, projection="polar", theta_offset=math.pi / 2)
-            verf(probe, concat, fig, ax)
-            ax.set_title(f"Quotient")
-            print("Quotient done")
-            return fig
-
-        def draw_time_fig(
-            probe: ProbeBase, concat: ConcatInfo, i, r, theta, theta_text
-        ):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1)
-            draw_time_hist(probe, concat, r, theta, fig, ax)
-            ax.legend()
-            ax.set_xlabel("t/ns")
-            ax.set_title(f"Time r={r} $\\theta$={theta_text}")
-            print("Time", i + 1, "done")
-            return fig
-
-        with PdfPages(args.opt) as pp:
-            probe = get_probe()
-
-            pool = mp.Pool(3 + len(hist_rths))
-            figures = []
-
-            figures.append(pool.apply_async(draw_log_pie_fig, (probe,)))
-            figures.append(pool.apply_async(draw_real_pie_fig, (concat,)))
-            figures.append(pool.apply_async(draw_quotient_fig, (probe, concat)))
-            for i, (r, theta, theta_text) in enumerate(hist_rths):
-                figures.append(
-                    pool.apply_async(
-                        draw_time_fig, (probe, concat, i, r, theta, theta_text)
-                    )
+        histogram = args.histogram or os.environ.get(HISTOGRAM_ENV, HISTOGRAM)
+        probe = get_probe(histogram)
+        tasks = panel_tasks(histogram, args.concat, probe)
+        filenames = [panel_filename(args.cache, kind, key) for kind, key, _, _ in tasks]
+        missing = [
+            (kind, filename, params)
+            for (kind, _, params, _), filename in zip(tasks, filenames)
+            if not os.path.exists(filename)
+        ]
+
+        # compute the data of the missing panels in worker processes, which
+        # memory map the concat arrays instead of receiving copies
+        if missing:
+            concat = ConcatInfo(args.concat, stream=True)
+            concat.share(
+                os.path.join(args.cache, f"concat-{digest(repr(file_key(args.concat)))}")
+            )
+            # build the spatial index once, before the panels query it in parallel
+            concat.index
+            os.makedirs(args.cache, exist_ok=True)
+            with Pool(processes=args.jobs) as pool:
+                results = pool.imap_unordered(
+                    profiling.Traced(compute_panel),
+                    [(kind, filename, probe, concat, params) for kind, filename, params in missing],
                 )
+                for filename in map(profiling.unpack, results):
+                    print(os.path.basename(filename), "done")
 
-            pool.close()
-            pool.join()
-
-            for fig in figures:
-                pp.savefig(figure=fig.get())
+        # render the pages from the cached data in this process
+        with PdfPages(args.opt) as pp:
+            for (kind, _, params, text), filename in zip(tasks, filenames):
+                with np.load(filename) as data:
+                    fig = render_page(kind, dict(data), params, text)
+                with profiling.span("draw.render"):
+                    pp.savefig(figure=fig)
+                plt.close(fig)
 
     elif args.command == "validate":
-        concat = ConcatInfo(args.concat)
-        probe = get_probe()
-        s = Validate(probe, concat)
+        concat = ConcatInfo(args.concat, stream=True)
+        probe = get_probe(args.histogram)
+        s = Validate(probe, concat, args.jobs, args.grid if args.binned else None)
         if "JUNOPROBE_SCORE" in os.environ:
             t = time.time()
             print(f"{s},{t}")
@@ -1,72 +1,926 @@
 from multiprocessing import Pool
 import argparse
+import csv
+import glob
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
 import numpy as np
 import h5py
 from tqdm import tqdm
+import profiling
+import reader
+from coefficient import ConcatInfo, STATISTICS_GRID, digitize
+from probe import Probe
 
 # PMT数量
 N = 17612
 # 液闪区域半径(mm)
 R0 = 17710
-# 数据文件编号
-Seq = np.arange(16001, 16002)
-# 数据文件个数
-N0 = 1
 # probe函数积分上限(ns)
 T_max = 1000
+# 几何计算中每个[顶点, PMT]对占用的临时内存上限(字节)
+PAIR_BYTES = 40
+# 几何缓存格式版本, 缓存内容变化时递增
+CACHE_VERSION = 2
+# 空格子的填充方式
+FILL = ("mean", "none", "half")
+# 分箱方式
+BINNING = ("uniform", "adaptive")
+# 自适应分箱的查找表: 数据集名称, 在r³, 1-cosθ与t/T_max上各有LOOKUP_FACTOR倍分箱数个均匀格子
+LOOKUP = ("R_Lookup", "Theta_Lookup", "T_Lookup")
+LOOKUP_FACTOR = 16
+# 自适应分箱中PE分布的权重, 其余权重为在r³, 1-cosθ与t上均匀的曝光分布
+ADAPTIVE_PE_WEIGHT = 0.5
+# 低秩分解的乘法更新迭代次数
+NMF_ITERATIONS = 1000
+# concat文件中PE与[顶点, PMT]对的数据类型, 与ConcatInfo读取的格式相同
+CONCAT_DTYPE = np.dtype([('r', '<f8'), ('theta', '<f8'), ('t', '<f8')])
+VERTICES_DTYPE = np.dtype([('r', '<f8'), ('theta', '<f8')])
+# concat文件数据集的分块长度
+CONCAT_CHUNK = 2**16
+# sweep子命令默认的几何缓存目录
+SWEEP_CACHE = "histogram_cache"
+# sweep子命令输出表格的列
+SWEEP_FIELDS = ("bins", "theta_bins", "tbins", "fill", "score", "build_seconds",
+                "lookup_seconds", "table_bytes")
+
+def get_chunk(max_memory, chunk=None):
+    """
+    get_chunk() 函数
+
+    根据每个进程的内存上限max_memory(MB)计算几何计算中每块的顶点数目。
+    若显式给定chunk, 则直接使用chunk。
+    """
+    if chunk is not None:
+        return max(int(chunk), 1)
+    return max(int(max_memory * 2**20 // (N * PAIR_BYTES)), 1)
+
+def pmt_direction(geo_theta, geo_phi):
+    """
+    pmt_direction() 函数
+
+    由PMT的球坐标角度计算各PMT的单位方向向量, 形状为(N, 3)。
+    """
+    return np.stack([np.sin(geo_theta) * np.cos(geo_phi),
+                     np.sin(geo_theta) * np.sin(geo_phi),
+                     np.cos(geo_theta)], axis=-1).reshape(-1, 3)
+
+def read_pmt(geo_file):
+    """
+    read_pmt() 函数
+
+    读取几何文件geo_file, 返回前N个PMT的单位方向向量, 形状为(N, 3)。
+    """
+    with h5py.File(geo_file, 'r') as h5file_r:
+        geo = h5file_r["Geometry"][...]
+    geo_theta = np.deg2rad(geo["theta"][None, :N])
+    geo_phi = np.deg2rad(geo["phi"][None, :N])
+    return pmt_direction(geo_theta, geo_phi)
+
+def read_events(filename, start=0, stop=None):
+    """
+    read_events() 函数
+
+    读取一个数据文件中第start到stop个顶点及其PE, 返回各顶点的归一化位置vertex,
+    每个PE对应的顶点序号event, PMT序号channel和时间t, 以及各顶点的PE在PE数组中的
+    起止位置offset(长度为顶点数目+1)。PE按顶点顺序排列, 同一顶点的PE保持文件中的顺序。
+
+    每个PE只由其(EventID, ChannelID)确定对应的顶点与PMT, 不构造稠密的[顶点, PMT]矩阵。
+    只读取需要的列, 时间列的名称由数据类型确定, 见reader.py。
+    """
+    return reader.get_reader(filename).read(start, stop)
+
+def read_file(filename, pmt, start=0, stop=None):
+    """
+    read_file() 函数
+
+    读取一个训练数据文件中第start到stop个顶点及其PE, 见get_geometry()。
+    """
+    return get_geometry(read_events(filename, start, stop), pmt)
+
+def get_geometry(events, pmt):
+    """
+    get_geometry() 函数
+
+    由read_events()的结果events计算各顶点的单位方向向量u和归一化半径r,
+    每个PE对应的(r, θ, t), 以及各顶点的PE在PE数组中的起止位置offset
+    (长度为顶点数目+1)。r, θ, t均为float32, PE按顶点顺序排列。
+    """
+    vertex, event, channel, t, offset = events
+    r = np.sqrt(np.sum(vertex**2, axis=1))
+    u = (vertex / np.where(r > 0, r, 1)[:, None]).astype(np.float32)
+    r = r.astype(np.float32)
+
+    # 与get_exposure使用相同的float32精度, 保证同一[顶点, PMT]对落入同一格子
+    pe_θ = np.arccos(np.clip(np.sum(
+        u[event] * pmt[channel].astype(np.float32), axis=1), -1, 1))
+    return u, r, r[event], pe_θ, t.astype(np.float32), offset
+
+def bin_pe(pe_r, pe_θ, pe_t, bins, tbins, r_bins, theta_bins, t_bins=None):
+    """
+    bin_pe() 函数
+
+    所有PE一次性落入(r, θ, t)格子, 返回每个格子中的PE数目。
+    bins为r格子数目, θ格子数目由theta_bins确定。
+    t_bins为t格子边界, 为None时在[0, T_max]上均匀分为tbins格。
+    """
+    theta_count = len(theta_bins) - 1
+    r_idx = digitize(pe_r, r_bins)
+    θ_idx = digitize(pe_θ, theta_bins)
+    if t_bins is None:
+        t_bins = np.linspace(0, T_max, tbins + 1)
+    t_idx = digitize(pe_t, t_bins)
+    valid = (r_idx >= 0) & (θ_idx >= 0) & (t_idx >= 0)
+    return np.bincount(((r_idx * theta_count + θ_idx) * tbins + t_idx)[valid],
+                       minlength=bins * theta_count * tbins).reshape(bins, theta_count,
+                                                                     tbins)
+
+def get_exposure(u, r_idx, pmt, bins, theta_bins, chunk):
+    """
+    get_exposure() 函数
+
+    分块遍历顶点, 统计每个(r, θ)格子中[顶点, PMT]对出现的次数。
+
+    u为顶点的单位方向向量, r_idx为顶点所在的r格子序号, pmt为PMT的单位方向向量,
+    chunk为每块的顶点数目。每块只占用 chunk * N 个float32的临时内存。
+    """
+    theta_count = len(theta_bins) - 1
+    num = np.zeros(bins * theta_count, dtype=np.int64)
+    pmt = pmt.astype(np.float32).T
+    for start in range(0, len(u), chunk):
+        u_chunk = u[start:start+chunk].astype(np.float32)
+        r_chunk = r_idx[start:start+chunk, None]
+        θ_idx = digitize(np.arccos(np.clip(u_chunk @ pmt, -1, 1)), theta_bins)
+        valid = (r_chunk >= 0) & (θ_idx >= 0)
+        num += np.bincount((r_chunk * theta_count + θ_idx)[valid],
+                           minlength=bins * theta_count)
+    return num.reshape(bins, theta_count)
+
+def get_cached_exposure(r, θ, bins, r_bins, theta_bins, chunk):
+    """
+    get_cached_exposure() 函数
+
+    与get_exposure()相同, 但从缓存的θ矩阵分块统计, 不再计算三角函数。
+    缓存的θ与get_exposure()以相同的float32运算得到, 因此两者落入相同的格子。
+    """
+    theta_count = len(theta_bins) - 1
+    num = np.zeros(bins * theta_count, dtype=np.int64)
+    r_idx = digitize(r, r_bins)
+    for start in range(0, len(r), chunk):
+        r_chunk = r_idx[start:start+chunk, None]
+        θ_idx = digitize(θ[start:start+chunk], theta_bins)
+        valid = (r_chunk >= 0) & (θ_idx >= 0)
+        num += np.bincount((r_chunk * theta_count + θ_idx)[valid],
+                           minlength=bins * theta_count)
+    return num.reshape(bins, theta_count)
+
+def file_hash(filename):
+    """
+    file_hash() 函数
+
+    计算文件内容的哈希值, 用作几何缓存的键。
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**23), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def get_cache(Arguments):
+    """
+    get_cache() 函数
+
+    返回训练数据文件filename的几何缓存目录, 缓存不存在时分块计算并写入。
+
+    缓存包括各顶点的r, 各[顶点, PMT]对的θ, 每个PE的(r, θ, t)以及各顶点的PE
+    在PE数组中的起止位置。缓存以数据文件与几何文件的内容哈希为键, 保存在cache
+    目录下的一个子目录中, 每个数组为一个.npy文件。
+    """
+    filename, pmt, chunk, cache, geo_hash = Arguments
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{file_hash(filename)}:{geo_hash}"
+                          .encode(), digest_size=16).hexdigest()
+    path = os.path.join(cache, key)
+    if not os.path.isdir(path):
+        with profiling.span("histogram.cache"):
+            write_cache(filename, pmt, chunk, cache, key)
+    return filename, path
+
+def write_cache(filename, pmt, chunk, cache, key):
+    """
+    write_cache() 函数
+
+    分块计算训练数据文件filename的几何缓存, 先写入临时目录, 再改名为cache/key。
+    """
+    u, r, pe_r, pe_θ, pe_t, offset = read_file(filename, pmt)
+    tmp = tempfile.mkdtemp(dir=cache, prefix=f".{key}.")
+    θ = np.lib.format.open_memmap(os.path.join(tmp, "theta.npy"), mode='w+',
+                                  dtype=np.float32, shape=(len(u), len(pmt)))
+    pmt_T = pmt.astype(np.float32).T
+    for start in range(0, len(u), chunk):
+        # 与get_exposure()相同的float32运算
+        θ[start:start+chunk] = np.arccos(np.clip(u[start:start+chunk] @ pmt_T, -1, 1))
+    θ.flush()
+    del θ
+    for name, array in (("r", r), ("pe_r", pe_r), ("pe_theta", pe_θ),
+                        ("pe_t", pe_t), ("offset", offset)):
+        np.save(os.path.join(tmp, f"{name}.npy"), array)
+    try:
+        os.rename(tmp, os.path.join(cache, key))
+    except OSError:
+        # 其他进程已经写入了相同的缓存
+        shutil.rmtree(tmp)
+
+def load_cache(path, start=0, stop=None):
+    """
+    load_cache() 函数
+
+    以内存映射方式打开几何缓存目录path, 返回第start到stop个顶点的r, θ,
+    以及这些顶点的PE的(r, θ, t)。
+    """
+    def load(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+
+    offset = load("offset")
+    stop = len(offset) - 1 if stop is None else stop
+    lo, hi = offset[start], offset[stop]
+    return (load("r")[start:stop], load("theta")[start:stop],
+            load("pe_r")[lo:hi], load("pe_theta")[lo:hi], load("pe_t")[lo:hi])
+
+def check_cache(Arguments):
+    """
+    check_cache() 函数
+
+    对几何缓存目录path的前chunk个顶点, 分别由训练数据文件filename直接计算与由缓存
+    统计每个(r, θ)格子中[顶点, PMT]对出现的次数, 二者不同时报错。
+    """
+    filename, path, pmt, r_bins, theta_bins, chunk = Arguments
+    bins = len(r_bins) - 1
+    r, θ = (a[:chunk] for a in load_cache(path)[:2])
+    u, r_direct = read_file(filename, pmt, 0, len(r))[:2]
+    direct = get_exposure(u, digitize(r_direct, r_bins), pmt, bins, theta_bins, chunk)
+    cached = get_cached_exposure(r, θ, bins, r_bins, theta_bins, chunk)
+    if not np.array_equal(direct, cached):
+        raise ValueError(f"the geometry cache {path} of {filename} disagrees with the "
+                         f"data in {np.count_nonzero(direct != cached)} (r, θ) cells")
+    return filename
 
 def get_probe(Arguments):
     """
     get_probe() 函数
 
-    本函数用于对一组数据计算probe函数。
+    本函数用于对一个数据文件中的一段顶点计算probe函数的部分和。
+
+    输入为数据文件名filename，顶点范围start和stop，以及argument:
+    PMT的单位方向向量pmt，r方向bins格子数量(θ方向由其格子边界确定)，t方向格子数量tbins，
+    r和theta方向格子边界，几何计算每块的顶点数目chunk，t方向格子边界t_bins
+    (为None时均匀分箱)；
+    最后为该文件的几何缓存目录path(为None时不使用缓存)。
+
+    所有PE只按照(EventID, ChannelID)找到对应的顶点与PMT, 一次性落入(r, θ, t)格子;
+    [顶点, PMT]对的出现次数只统计一次, 与时间格子数无关。
+
+    返回每个(r, θ, t)格子中的PE数目, 和每个(r, θ)格子中[顶点, PMT]对出现的次数,
+    二者对不同的文件和顶点范围均可直接相加。
+    """
+    filename, start, stop, argument, path = Arguments
+    pmt, bins, tbins, r_bins, theta_bins, chunk, t_bins = argument
+
+    # 每个(r, θ)组合出现的次数统计: 只计算一次, 按顶点分块
+    if path is None:
+        sum_probe = np.zeros((bins, len(theta_bins) - 1, tbins), dtype=np.int64)
+        num = np.zeros((bins, len(theta_bins) - 1), dtype=np.int64)
+        # 后台线程读取下一块顶点的同时, 当前块落入格子
+        blocks = reader.get_reader(filename).chunks(start, stop, chunk)
+        for _, events in reader.prefetch(blocks):
+            u, r, pe_r, pe_θ, pe_t, _ = get_geometry(events, pmt)
+            with profiling.span("histogram.exposure", len(u) * len(pmt)):
+                num += get_exposure(u, digitize(r, r_bins), pmt, bins, theta_bins, chunk)
+            with profiling.span("histogram.bin_pe", len(pe_r)):
+                sum_probe += bin_pe(pe_r, pe_θ, pe_t, bins, tbins, r_bins, theta_bins,
+                                    t_bins)
+        return sum_probe, num
+    else:
+        with profiling.span("histogram.read", stop - start):
+            r, θ, pe_r, pe_θ, pe_t = load_cache(path, start, stop)
+        with profiling.span("histogram.exposure", θ.size):
+            num = get_cached_exposure(r, θ, bins, r_bins, theta_bins, chunk)
+
+    # 所有PE一次性落入(r, θ, t)格子
+    with profiling.span("histogram.bin_pe", len(pe_r)):
+        sum_probe = bin_pe(pe_r, pe_θ, pe_t, bins, tbins, r_bins, theta_bins, t_bins)
+    return sum_probe, num
+
+def get_marginals(Arguments):
+    """
+    get_marginals() 函数
+
+    统计一个数据文件中一段顶点的PE在r³, 1-cosθ与t/T_max上的一维分布,
+    三者分别在[0, 1]上均匀分为r_grid, theta_grid与t_grid个格子。
+    """
+    filename, start, stop, pmt, r_grid, theta_grid, t_grid, chunk = Arguments
+    marginals = [np.zeros(grid, dtype=np.int64) for grid in (r_grid, theta_grid, t_grid)]
+    blocks = reader.get_reader(filename).chunks(start, stop, chunk)
+    for _, events in reader.prefetch(blocks):
+        _, _, pe_r, pe_θ, pe_t, _ = get_geometry(events, pmt)
+        with profiling.span("histogram.marginals", len(pe_r)):
+            for marginal, x in zip(marginals, (pe_r.astype(np.float64) ** 3,
+                                               1 - np.cos(pe_θ.astype(np.float64)),
+                                               pe_t.astype(np.float64) / T_max)):
+                idx = digitize(x, np.linspace(0, 1, len(marginal) + 1))
+                marginal += np.bincount(idx[idx >= 0], minlength=len(marginal))
+    return marginals
+
+def adaptive_edges(counts, bins):
+    """
+    adaptive_edges() 函数
+
+    由PE在查找表格子上的一维分布counts选取bins个格子的边界, 返回边界所在的
+    查找表格子序号(长度为bins+1, 从0到len(counts))。
+
+    边界取PE分布与均匀的曝光分布以ADAPTIVE_PE_WEIGHT混合后的分位数, 因此PE密集的
+    区域格子更细, 而PE稀少的区域格子也不会过宽。每个格子至少包含一个查找表格子。
+    """
+    grid = len(counts)
+    weight = (ADAPTIVE_PE_WEIGHT * counts / max(counts.sum(), 1)
+              + (1 - ADAPTIVE_PE_WEIGHT) / grid)
+    cdf = np.concatenate([[0], np.cumsum(weight)])
+    idx = np.concatenate([[0], np.searchsorted(cdf, np.arange(1, bins) / bins * cdf[-1]),
+                          [grid]])
+    for i in range(1, bins):
+        idx[i] = max(idx[i], idx[i-1] + 1)
+    for i in range(bins - 1, 0, -1):
+        idx[i] = min(idx[i], idx[i+1] - 1)
+    return idx
+
+def adaptive_binning(geo_file, files, bins, tbins, jobs, chunk, theta_count=None):
+    """
+    adaptive_binning() 函数
+
+    由训练数据中PE的一维分布选取等统计量的r, θ与t格子边界, 见adaptive_edges()。
+
+    边界均落在r³, 1-cosθ与t上的均匀查找表格子的边界上, 因此查找表LOOKUP
+    将每个均匀格子映射到唯一的格子, probe.py仍以常数时间查表。
+    θ格子数目theta_count为None时与r格子数目bins相同。
+    数据按每块chunk个顶点读取。返回r, θ, t格子边界以及查找表。
+    """
+    theta_count = bins if theta_count is None else theta_count
+    pmt = read_pmt(geo_file)
+    grids = (LOOKUP_FACTOR * bins, LOOKUP_FACTOR * theta_count, LOOKUP_FACTOR * tbins)
+    tasks = [(filename, start, stop, pmt) + grids + (chunk,)
+             for filename, start, stop in get_tasks(files, jobs)]
+    marginals = [np.zeros(grid, dtype=np.int64) for grid in grids]
+    with Pool(processes=jobs) as pool:
+        for parts in map(profiling.unpack,
+                         pool.imap_unordered(profiling.Traced(get_marginals), tasks)):
+            for marginal, part in zip(marginals, parts):
+                marginal += part
+
+    edges = [adaptive_edges(marginal, n)
+             for marginal, n in zip(marginals, (bins, theta_count, tbins))]
+    lookup = {name: np.repeat(np.arange(len(idx) - 1), np.diff(idx)).astype(np.int32)
+              for name, idx in zip(LOOKUP, edges)}
+    r_idx, θ_idx, t_idx = (idx / grid for idx, grid in zip(edges, grids))
+    return r_idx ** (1/3), np.arccos(1 - θ_idx), t_idx * T_max, lookup
+
+def get_concat(Arguments):
+    """
+    get_concat() 函数
+
+    计算一个数据文件中第start到stop个顶点的concat数据, 以float64计算。
+
+    返回这些顶点的所有[顶点, PMT]对的(r, θ)(顶点在前, PMT在后), 以及每个PE的
+    (r, θ, t)。PE的θ只由其所属的顶点与PMT的方向向量计算。
+    """
+    filename, start, stop, pmt = Arguments
+    with profiling.span("concat.read", stop - start):
+        vertex, event, channel, t, _ = read_events(filename, start, stop)
+    with profiling.span("concat.geometry", len(vertex) * len(pmt)):
+        r = np.sqrt(np.sum(vertex**2, axis=1))
+        u = vertex / np.where(r > 0, r, 1)[:, None]
+        vertices = np.empty((len(r), len(pmt)), dtype=VERTICES_DTYPE)
+        vertices['r'] = r[:, None]
+        vertices['theta'] = np.arccos(np.clip(u @ pmt.T, -1, 1))
+
+        pes = np.empty(len(event), dtype=CONCAT_DTYPE)
+        pes['r'] = r[event]
+        pes['theta'] = np.arccos(np.clip(np.sum(u[event] * pmt[channel], axis=1), -1, 1))
+        pes['t'] = t
+    return vertices.reshape(-1), pes
+
+def append(dataset, rows):
+    """
+    append() 函数
+
+    将rows追加到可变长度的数据集dataset末尾。
+    """
+    dataset.resize((len(dataset) + len(rows),))
+    dataset[len(dataset) - len(rows):] = rows
+
+def get_files(data):
+    """
+    get_files() 函数
+
+    将--data给出的文件、通配符或文件夹展开为训练数据文件列表。
+    文件夹展开为其中所有的.h5文件。
+    """
+    files = []
+    for pattern in data:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.h5")
+        matched = sorted(glob.glob(pattern))
+        if not matched:
+            raise FileNotFoundError(f"no training data matches {pattern}")
+        files.extend(matched)
+    return files
 
-    输入为数据文件序号i，数据文件夹名data，几何数据geo_theta和geo_phi，
-    r和theta方向bins格子数量和theta方向格子数量。
+def get_tasks(files, jobs):
     """
-    i, argument, geo_theta, geo_phi = Arguments
+    get_tasks() 函数
 
-    # read the file
-    with h5py.File(f"{argument[0]}/{i}.h5", 'r') as h5file_r:
-        ParticleTruth = h5file_r["ParticleTruth"][...]
-        PETruth = h5file_r["PETruth"][...]
+    将每个文件按顶点划分为若干段, 使任务数目至少为进程数的4倍,
+    文件较少时各进程也能保持忙碌。返回(filename, start, stop)的列表。
+    """
+    split = max(-(-4 * jobs // len(files)), 1)
+    tasks = []
+    for filename in files:
+        with h5py.File(filename, 'r') as h5file_r:
+            n = len(h5file_r["ParticleTruth"])
+        edges = np.linspace(0, n, min(split, max(n, 1)) + 1).astype(int)
+        tasks.extend((filename, start, stop)
+                     for start, stop in zip(edges[:-1], edges[1:]))
+    return tasks
 
-    # 计算各顶点的归一化位置, 和各PMT的位置
-    x = ParticleTruth['x'][:, None] / R0
-    y = ParticleTruth['y'][:, None] / R0
-    z = ParticleTruth['z'][:, None] / R0
+def uniform_edges(bins, theta_count):
+    """
+    uniform_edges() 函数
 
-    n = np.size(ParticleTruth)
-    probe = np.zeros((argument[1], argument[1], argument[2]))
+    返回在r³上均匀的bins个r格子与在cosθ上均匀的theta_count个θ格子的边界。
+    """
+    r_bins = (np.arange(bins+1) / bins) ** (1/3)
+    theta_bins = np.arccos(np.arange(theta_count+1) / theta_count)[::-1]
+    return r_bins, theta_bins
 
-    # 计算各[顶点, PMT]对应的probe函数的r和θ
-    r = np.sqrt(x**2 + y**2 + z**2) * np.ones((n, N))
-    θ = np.arccos(np.clip((x * np.sin(geo_theta) * np.cos(geo_phi)
-                            + y * np.sin(geo_theta) * np.sin(geo_phi)
-                            + z * np.cos(geo_theta)) / r, -1, 1)).flatten()
-    θ = np.min(np.array([θ, 2*np.pi - θ]), axis=0)
-    r = r.flatten()
+def finalize(sum_probe, num, tbins, fill="mean", t_bins=None):
+    """
+    finalize() 函数
 
-    # 对每个t格子
-    for j in tqdm(range(argument[2])):
-        Bin_T = np.arange(j, j+2) * T_max / argument[2]
+    由各格子的PE数目sum_probe和[顶点, PMT]对数目num计算probe函数。
+    t_bins为t格子边界, 为None时在[0, T_max]上均匀分为tbins格。
 
-        # 每个(r, θ)组合出现的次数统计
-        hist_pmt_j = np.histogramdd(
-            np.array([PETruth["EventID"], PETruth["ChannelID"], PETruth["PETime"]]).T,
-            bins=[np.arange(len(ParticleTruth)+1), np.arange(N+1), Bin_T])[0].flatten()
+    fill为空格子的填充方式: "mean"将每个t格子中的零值替换为其中其余元素的平均值,
+    整个t格子都为零时替换为全体非零元素的最小值; "none"保留零值; "half"将没有PE
+    但有[顶点, PMT]对的格子视为有0.5个PE, 没有[顶点, PMT]对的格子同"mean"。
+    "half"不会把PE密集区域的平均值填入真正几乎没有PE的格子, 适合自适应分箱。
+    """
+    # 在每个格子里对(r, θ)组合出现的次数取平均, 结果为(sum_probe / num)
+    counts = np.maximum(sum_probe, 0.5) if fill == "half" else sum_probe
+    probe = np.where(num[:, :, None] > 0,
+                     counts / np.maximum(num, 1)[:, :, None], 0)
+
+    if fill in ("mean", "half"):
+        # 将每个t格子中数组的零值替换为其中其余元素的平均值
+        floor = probe[probe != 0].min() if np.any(probe != 0) else 0
+        for j in range(tbins):
+            nonzero = probe[:, :, j][probe[:, :, j] != 0]
+            probe[:, :, j][probe[:, :, j] == 0] = nonzero.mean() if len(nonzero) else floor
+
+    if t_bins is None:
+        return probe * tbins / T_max
+    return probe / np.diff(t_bins)
+
+def explained_variance(probe):
+    """
+    explained_variance() 函数
+
+    将probe函数看作(r, θ)格子数 × t格子数的矩阵, 返回截断SVD保留前k个奇异值时
+    解释的方差比例, 第k-1个元素对应秩k。用于选择factorize()的秩。
+    """
+    bins, theta_count, tbins = probe.shape
+    singular = np.linalg.svd(probe.reshape(bins * theta_count, tbins), compute_uv=False)
+    return np.cumsum(singular**2) / np.sum(singular**2)
 
-        # 在每个格子里对(r, θ)组合出现的次数取平均, 结果为(sum_probe / num)
-        sum_probe = np.histogram2d(r, θ,
-            bins=[argument[3], argument[4]], weights=hist_pmt_j)[0]
-        num = np.histogram2d(r, θ, bins=[argument[3], argument[4]])[0]
+def factorize(probe, num, rank, t_bins=None, iterations=NMF_ITERATIONS):
+    """
+    factorize() 函数
+
+    将probe函数分解为rank个非负的空间因子a_k(r, θ)与时间因子b_k(t)之积的和,
+    返回形状为(r格子数, θ格子数, rank)的Spatial与(rank, tbins)的Temporal。
+
+    分解的目标是每个格子中期望PE数目的泊松似然, 即以[顶点, PMT]对数目num加权的
+    KL散度, 用乘法更新迭代iterations次。初值取截断SVD各分量中较大的非负部分,
+    其余的零值替换为平均值, 因此因子始终为正, 对数probe有限。
+    """
+    bins, theta_count, tbins = probe.shape
+    width = np.full(tbins, T_max / tbins) if t_bins is None else np.diff(t_bins)
+    # 每个[顶点, PMT]对在各格子中的期望PE数目, 行权重为[顶点, PMT]对数目
+    v = probe.reshape(bins * theta_count, tbins) * width
+    w = num.reshape(-1, 1).astype(np.float64)
+
+    tiny = np.finfo(np.float64).tiny
+    u, singular, vt = np.linalg.svd(v, full_matrices=False)
+    spatial = np.empty((bins * theta_count, rank))
+    temporal = np.empty((rank, tbins))
+    for k in range(rank):
+        # 取正部分与负部分中范数之积较大的一个
+        x, y = np.maximum(u[:, k], 0), np.maximum(vt[k], 0)
+        xn, yn = np.maximum(-u[:, k], 0), np.maximum(-vt[k], 0)
+        if np.linalg.norm(xn) * np.linalg.norm(yn) > np.linalg.norm(x) * np.linalg.norm(y):
+            x, y = xn, yn
+        x_norm, y_norm = max(np.linalg.norm(x), tiny), max(np.linalg.norm(y), tiny)
+        spatial[:, k] = np.sqrt(singular[k] * y_norm / x_norm) * x
+        temporal[k] = np.sqrt(singular[k] * x_norm / y_norm) * y
+    mean = v.mean()
+    spatial[spatial <= 0] = mean
+    temporal[temporal <= 0] = mean
+
+    for _ in range(iterations):
+        ratio = v / np.maximum(spatial @ temporal, tiny)
+        # 空间因子的更新中行权重相消, 没有[顶点, PMT]对的格子拟合填充值
+        spatial *= (ratio @ temporal.T) / temporal.sum(axis=1)
+        ratio = v / np.maximum(spatial @ temporal, tiny)
+        temporal *= (spatial.T @ (w * ratio)) / np.maximum(spatial.T @ w, tiny)
+    return spatial.reshape(bins, theta_count, rank), temporal / width
+
+def write_factors(h5file_w, probe, num, rank, t_bins=None):
+    """
+    write_factors() 函数
+
+    将probe函数的秩rank分解Spatial与Temporal以及解释方差曲线Explained_Variance
+    写入已打开的HDF5文件, 见factorize()。已有的分解会被替换。
+    """
+    spatial, temporal = factorize(probe, num, rank, t_bins)
+    for name in ("Spatial", "Temporal", "Explained_Variance"):
+        if name in h5file_w:
+            del h5file_w[name]
+    h5file_w.create_dataset('Spatial', data=spatial)
+    h5file_w.create_dataset('Temporal', data=temporal)
+    h5file_w.create_dataset('Explained_Variance', data=explained_variance(probe))
+
+def write_probe(filename, sum_probe, num, r_bins, theta_bins, fill="mean",
+                t_bins=None, lookup=None, rank=None):
+    """
+    write_probe() 函数
 
-        probe[:, :, j] += np.where(num > 0, sum_probe / num, 0)
+    将PE数目Counts, [顶点, PMT]对数目Exposure, 由二者得到的probe函数Probe
+    及其对数LogProbe写入HDF5文件。Counts与Exposure可以由merge子命令直接相加。
+
+    自适应分箱时还写入t格子边界T_Edges与查找表LOOKUP, 见adaptive_binning()。
+    给定rank时还写入probe函数的低秩分解, 见write_factors()。
+    """
+    bins, _, tbins = sum_probe.shape
+    with h5py.File(filename, 'w') as h5file_w, profiling.span("histogram.write"):
+        h5file_w.create_dataset('Counts', data=sum_probe)
+        h5file_w.create_dataset('Exposure', data=num)
+        probe = finalize(sum_probe, num, tbins, fill, t_bins)
+        # Probe与LogProbe连续存储且不压缩, probe.py可以直接内存映射
+        with np.errstate(divide='ignore'):
+            h5file_w.create_dataset('LogProbe', data=np.log(probe), chunks=None)
+        dataset = h5file_w.create_dataset('Probe', data=probe, chunks=None)
+        dataset.attrs['Bins'] = bins
+        dataset.attrs['T_Bins'] = tbins
+        dataset.attrs['R_Bins'] = r_bins
+        dataset.attrs['Theta_Bins'] = theta_bins
+        dataset.attrs['Fill'] = fill
+        if t_bins is not None:
+            dataset.attrs['T_Edges'] = t_bins
+        for name, table in (lookup or {}).items():
+            h5file_w.create_dataset(name, data=table)
+        if rank is not None:
+            with profiling.span("histogram.factorize"):
+                write_factors(h5file_w, probe, num, rank, t_bins)
+
+def read_partial(filename):
+    """
+    read_partial() 函数
+
+    读取write_probe()写入的文件, 返回PE数目, [顶点, PMT]对数目, r和θ格子边界,
+    t格子边界(均匀分箱时为None), 查找表(均匀分箱时为None)以及空格子的填充方式
+    (未记录时为None)。
+    """
+    with h5py.File(filename, 'r') as h5file_r:
+        if "Counts" not in h5file_r or "Exposure" not in h5file_r:
+            raise ValueError(f"{filename} has no Counts/Exposure to merge")
+        probe_data = h5file_r["Probe"]
+        lookup = {name: h5file_r[name][...] for name in LOOKUP if name in h5file_r}
+        return (h5file_r["Counts"][...], h5file_r["Exposure"][...],
+                probe_data.attrs['R_Bins'], probe_data.attrs['Theta_Bins'],
+                probe_data.attrs.get('T_Edges'), lookup or None,
+                probe_data.attrs.get('Fill'))
+
+def get_paths(pool, geo_file, files, pmt, chunk, cache):
+    """
+    get_paths() 函数
+
+    由进程池pool为训练数据文件列表files中的每个文件准备几何缓存, 见get_cache()。
+    返回文件名到缓存目录的字典, cache为None时各文件的缓存目录均为None。
+    """
+    paths = dict.fromkeys(files)
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        geo_hash = file_hash(geo_file)
+        paths.update(map(profiling.unpack, pool.imap_unordered(
+            profiling.Traced(get_cache),
+            [(filename, pmt, chunk, cache, geo_hash) for filename in files])))
+    return paths
+
+def accumulate(geo_file, files, r_bins, theta_bins, tbins, chunk, jobs, cache=None,
+               t_bins=None, verify=False):
+    """
+    accumulate() 函数
+
+    由几何文件geo_file和训练数据文件列表files, 在给定的r, θ格子边界与tbins个t格子上
+    统计每个(r, θ, t)格子中的PE数目和每个(r, θ)格子中[顶点, PMT]对出现的次数。
+    r与θ的格子数目可以不同。t_bins为t格子边界, 为None时均匀分箱。
+    verify时用check_cache()检查各文件的几何缓存, 缓存格式的变化由CACHE_VERSION区分。
+    """
+    bins = len(r_bins) - 1
+    pmt = read_pmt(geo_file)
+    argument = (pmt, bins, tbins, r_bins, theta_bins, chunk, t_bins)
+
+    sum_probe = np.zeros((bins, len(theta_bins) - 1, tbins), dtype=np.int64)
+    num = np.zeros((bins, len(theta_bins) - 1), dtype=np.int64)
+    with Pool(processes=jobs) as pool:
+        paths = get_paths(pool, geo_file, files, pmt, chunk, cache)
+        if cache is not None and verify:
+            # 缓存与直接计算须落入相同的格子, 每个文件只检查前chunk个顶点
+            for _ in pool.imap_unordered(check_cache, [
+                    (filename, path, pmt, r_bins, theta_bins, chunk)
+                    for filename, path in paths.items()]):
+                pass
+        tasks = [(filename, start, stop, argument, paths[filename])
+                 for filename, start, stop in get_tasks(files, jobs)]
+        # 逐个累加各进程返回的部分和, 父进程中只保留一份结果
+        results = pool.imap_unordered(profiling.Traced(get_probe), tasks)
+        for sum_part, num_part in tqdm(map(profiling.unpack, results),
+                                       total=len(tasks)):
+            sum_probe += sum_part
+            num += num_part
+    return sum_probe, num
+
+def get_sweep(Arguments):
+    """
+    get_sweep() 函数
+
+    对几何缓存目录path中第start到stop个顶点, 在spatial中的每组r, θ格子边界上统计
+    [顶点, PMT]对数目, 在每组空间格子与tbins_list中的每个t格子数目上统计PE数目。
+    θ矩阵每块chunk个顶点只读入内存一次, 由各组格子共用。
+
+    返回各组空间格子的[顶点, PMT]对数目, 以(空间格子序号, t格子数目)为键的PE数目,
+    以及各项的计算耗时(秒), 其中[顶点, PMT]对数目的耗时以(空间格子序号, None)为键。
+    """
+    path, start, stop, spatial, tbins_list, chunk = Arguments
+    with profiling.span("histogram.read", stop - start):
+        r, θ, pe_r, pe_θ, pe_t = load_cache(path, start, stop)
+        r, pe_r, pe_θ, pe_t = (np.array(a) for a in (r, pe_r, pe_θ, pe_t))
+    seconds = {}
+    nums = [np.zeros((len(r_bins) - 1, len(theta_bins) - 1), dtype=np.int64)
+            for r_bins, theta_bins in spatial]
+    for lo in range(0, len(r), chunk):
+        with profiling.span("histogram.read", min(chunk, len(r) - lo)):
+            block = np.array(θ[lo:lo+chunk])
+        for i, (r_bins, theta_bins) in enumerate(spatial):
+            begin = time.perf_counter()
+            with profiling.span("histogram.exposure", block.size):
+                nums[i] += get_cached_exposure(r[lo:lo+chunk], block, len(r_bins) - 1,
+                                               r_bins, theta_bins, len(block))
+            seconds[i, None] = seconds.get((i, None), 0) + time.perf_counter() - begin
+
+    sums = {}
+    for i, (r_bins, theta_bins) in enumerate(spatial):
+        for tbins in tbins_list:
+            begin = time.perf_counter()
+            with profiling.span("histogram.bin_pe", len(pe_r)):
+                sums[i, tbins] = bin_pe(pe_r, pe_θ, pe_t, len(r_bins) - 1, tbins,
+                                        r_bins, theta_bins)
+            seconds[i, tbins] = time.perf_counter() - begin
+    return nums, sums, seconds
+
+def score_table(Arguments):
+    """
+    score_table() 函数
+
+    由PE数目sum_probe与[顶点, PMT]对数目num写出probe表filename, 再由probe.py读取,
+    在留出的concat数据上评分。评分逐块求和, 与draw.py validate的结果相同, 但不检查
+    μ是否为光变曲线对时间的积分: 直方图probe的μ按定义就是该积分。
+    给定grid时由concat数据在grid上的PE与[顶点, PMT]对数目评分, 见ConcatInfo.statistics()。
+
+    返回评分, 写出probe表的耗时, 读取并查表评分的耗时(秒)以及probe表文件的大小(字节)。
+    """
+    filename, concat, sum_probe, num, r_bins, theta_bins, fill, grid = Arguments
+    begin = time.perf_counter()
+    write_probe(filename, sum_probe, num, r_bins, theta_bins, fill)
+    written = time.perf_counter()
+    probe = Probe(filename)
+    probe.load_data()
+    if grid is not None:
+        score = probe.validate_binned(concat, grid)
+    else:
+        nonhit = math.fsum(probe.sum_mu(*v) for v in concat.iter_vertices())
+        score = math.fsum(probe.sum_log_lc(*pe) for pe in concat.iter_pe()) - nonhit
+    return score, written - begin, time.perf_counter() - written, os.path.getsize(filename)
+
+def sweep(args):
+    """
+    sweep() 函数
+
+    在r, θ, t格子数目与空格子填充方式的所有组合上由训练数据构建probe函数,
+    并在留出的concat数据上评分, 见main()。
+
+    训练数据只计算一次几何缓存, 所有组合的直方图在同一遍读取缓存时统计; concat文件
+    也只读取一次, 以内存映射的数组供各进程评分。每个组合的构建耗时为其[顶点, PMT]对
+    与PE的统计耗时(各进程之和, 与进程数无关)加上写出probe表的耗时。
+    """
+    files = get_files(args.data)
+    pmt = read_pmt(args.geo)
+    chunk = get_chunk(args.max_memory, args.chunk)
+    spatial = list(dict.fromkeys((bins, theta_count) for bins in args.bins
+                                 for theta_count in (args.theta_bins or [bins])))
+    edges = [uniform_edges(bins, theta_count) for bins, theta_count in spatial]
+    tbins_list = list(dict.fromkeys(args.tbins))
+
+    with profiling.span("histogram.concat"):
+        key = file_hash(args.concat)
+        concat = ConcatInfo(args.concat, stream=True).share(
+            os.path.join(args.cache, f"concat-{key}"))
+        grid = tuple(args.grid) if args.binned else None
+        if grid is not None:
+            # 各进程从文件读取同一份计数
+            concat.statistics(grid)
+    tables = tempfile.mkdtemp() if args.tables is None else args.tables
+    os.makedirs(tables, exist_ok=True)
+
+    nums = [np.zeros((bins, theta_count), dtype=np.int64) for bins, theta_count in spatial]
+    sums = {(i, tbins): np.zeros((bins, theta_count, tbins), dtype=np.int64)
+            for i, (bins, theta_count) in enumerate(spatial) for tbins in tbins_list}
+    seconds = dict.fromkeys(list(sums) + [(i, None) for i in range(len(spatial))], 0)
+    try:
+        with Pool(processes=args.jobs) as pool:
+            paths = get_paths(pool, args.geo, files, pmt, chunk, args.cache)
+            tasks = [(paths[filename], start, stop, edges, tbins_list, chunk)
+                     for filename, start, stop in get_tasks(files, args.jobs)]
+            with profiling.span("histogram.accumulate"):
+                results = pool.imap_unordered(profiling.Traced(get_sweep), tasks)
+                for num_parts, sum_parts, second_parts in tqdm(
+                        map(profiling.unpack, results), total=len(tasks)):
+                    for num, part in zip(nums, num_parts):
+                        num += part
+                    for k, part in sum_parts.items():
+                        sums[k] += part
+                    for k, part in second_parts.items():
+                        seconds[k] += part
+
+            settings = [(i, tbins, fill) for i in range(len(spatial))
+                        for tbins in tbins_list for fill in args.fill]
+            score_tasks = [(os.path.join(tables, "b{}_a{}_t{}_{}.h5".format(
+                                *spatial[i], tbins, fill)),
+                            concat, sums[i, tbins], nums[i]) + edges[i] + (fill, grid)
+                           for i, tbins, fill in settings]
+            with profiling.span("histogram.score"):
+                scores = list(map(profiling.unpack, pool.imap(
+                    profiling.Traced(score_table), score_tasks)))
+    finally:
+        if args.tables is None:
+            shutil.rmtree(tables)
+
+    rows = []
+    for (i, tbins, fill), (score, write, lookup, size) in zip(settings, scores):
+        rows.append(dict(zip(SWEEP_FIELDS, (
+            *spatial[i], tbins, fill, score,
+            seconds[i, None] + seconds[i, tbins] + write, lookup, size))))
+    print(f"{'bins':>5} {'theta':>5} {'tbins':>5} {'fill':>5} {'score':>20} "
+          f"{'build/s':>8} {'lookup/s':>8} {'size/MB':>8}")
+    for row in sorted(rows, key=lambda row: -row["score"]):
+        print(f"{row['bins']:5d} {row['theta_bins']:5d} {row['tbins']:5d} "
+              f"{row['fill']:>5} {row['score']:20.6f} {row['build_seconds']:8.2f} "
+              f"{row['lookup_seconds']:8.2f} {row['table_bytes'] / 2**20:8.2f}")
+    if args.opt is not None:
+        with open(args.opt, "w", newline="") as report:
+            writer = csv.DictWriter(report, fieldnames=SWEEP_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def build(args):
+    """
+    build() 函数
+
+    由几何文件和训练数据文件计算probe函数, 见main()。
+    """
+    bins, tbins = int(args.Bins), int(args.T_Bins)
+    theta_count = bins if args.theta_bins is None else args.theta_bins
+    files = get_files(args.data)
+    chunk = get_chunk(args.max_memory, args.chunk)
+    fill = args.fill or ("half" if args.binning == "adaptive" else "mean")
+    if args.binning == "adaptive":
+        with profiling.span("histogram.binning"):
+            r_bins, theta_bins, t_bins, lookup = adaptive_binning(
+                args.geo, files, bins, tbins, args.jobs, chunk, theta_count)
+    else:
+        r_bins, theta_bins = uniform_edges(bins, theta_count)
+        t_bins, lookup = None, None
+    with profiling.span("histogram.accumulate"):
+        sum_probe, num = accumulate(args.geo, files, r_bins, theta_bins, tbins, chunk,
+                                    args.jobs, args.cache, t_bins, args.verify_cache)
+    write_probe(args.opt, sum_probe, num, r_bins, theta_bins, fill, t_bins, lookup,
+                args.rank)
+
+def merge(args):
+    """
+    merge() 函数
+
+    将多个build子命令的输出文件中的PE数目与[顶点, PMT]对数目分别相加,
+    再重新计算probe函数。各文件的分箱必须相同。
+
+    未给出填充方式时沿用各文件记录的填充方式, 各文件记录的填充方式必须相同。
+    """
+    sum_probe, num, r_bins, theta_bins, t_bins, lookup, fill = read_partial(args.inputs[0])
+    for filename in args.inputs[1:]:
+        sum_part, num_part, r_part, theta_part, t_part, _, fill_part = read_partial(filename)
+        if (sum_part.shape != sum_probe.shape or not np.array_equal(r_part, r_bins)
+                or not np.array_equal(theta_part, theta_bins)
+                or (t_part is None) != (t_bins is None)
+                or (t_bins is not None and not np.array_equal(t_part, t_bins))):
+            raise ValueError(f"{filename} has a different binning from {args.inputs[0]}")
+        if args.fill is None and fill_part != fill:
+            raise ValueError(f"{filename} has fill {fill_part} but {args.inputs[0]} has "
+                             f"fill {fill}, choose one by --fill")
+        sum_probe += sum_part
+        num += num_part
+
+    fill = args.fill or fill or ("half" if lookup is not None else "mean")
+    write_probe(args.opt, sum_probe, num, r_bins, theta_bins, fill, t_bins, lookup,
+                args.rank)
+
+def low_rank(args):
+    """
+    low_rank() 函数
+
+    打印probe函数的解释方差曲线与各秩的存储比例, 给定秩时将低秩分解写入输出文件,
+    见main()。
+    """
+    with h5py.File(args.input, 'r') as h5file_r:
+        probe = h5file_r["Probe"][...]
+        num = h5file_r["Exposure"][...]
+        t_bins = h5file_r["Probe"].attrs.get('T_Edges')
+    bins, theta_count, tbins = probe.shape
+    print("rank  explained  size")
+    for k, explained in enumerate(explained_variance(probe), 1):
+        print(f"{k:4d}  {explained:9.6f}  "
+              f"{k * (bins * theta_count + tbins) / probe.size:.4f}")
+    if args.rank is None:
+        return
+    opt = args.input if args.opt is None else args.opt
+    if opt != args.input:
+        shutil.copyfile(args.input, opt)
+    with h5py.File(opt, 'a') as h5file_w, profiling.span("histogram.factorize"):
+        write_factors(h5file_w, probe, num, args.rank, t_bins)
+
+def concat(args):
+    """
+    concat() 函数
+
+    由几何文件和数据文件生成concat文件, 见main()。
+
+    每个文件按顶点分块, 由多个进程并行计算; 父进程按文件与顶点的顺序依次写入,
+    因此输出与进程数无关。同时在计算中的块不超过进程数的2倍, 内存占用有界。
+    """
+    pmt = read_pmt(args.geo)
+    chunk = get_chunk(args.max_memory, args.chunk)
+    tasks = []
+    for filename in get_files(args.data):
+        with h5py.File(filename, 'r') as h5file_r:
+            n = len(h5file_r["ParticleTruth"])
+        tasks.extend((filename, start, min(start + chunk, n), pmt)
+                     for start in range(0, n, chunk))
+
+    with h5py.File(args.opt, 'w') as h5file_w, Pool(processes=args.jobs) as pool:
+        pe_data = h5file_w.create_dataset('Concat', shape=(0,), maxshape=(None,),
+                                          chunks=(CONCAT_CHUNK,), dtype=CONCAT_DTYPE)
+        vertex_data = h5file_w.create_dataset('Vertices', shape=(0,), maxshape=(None,),
+                                              chunks=(CONCAT_CHUNK,), dtype=VERTICES_DTYPE)
+        get_part = profiling.Traced(get_concat)
+        pending = deque()
+        progress = tqdm(total=len(tasks))
+
+        def write():
+            vertices, pes = profiling.unpack(pending.popleft().get())
+            with profiling.span("concat.write", len(vertices) + len(pes)):
+                append(vertex_data, vertices)
+                append(pe_data, pes)
+            progress.update()
+
+        for task in tasks:
+            pending.append(pool.apply_async(get_part, (task,)))
+            if len(pending) >= 2 * args.jobs:
+                write()
+        while pending:
+            write()
+        progress.close()
 
-        # 将数组的零值替换为其中其余元素的平均值
-        probe[:, :, j][probe[:, :, j] == 0] = probe[:, :, j][probe[:, :, j] != 0].mean()
-    
-    return probe
 def main():
     """
 	main() 函数
@@ -75,18 +929,61 @@ def main():
     输入数据包括几何文件和多个训练数据文件。
 
 	函数功能：
-	1. 解析命令行参数，获取输入的几何文件、训练数据文件夹路径、输出文件路径、空间和时间的分箱数。
+	有五个子命令: build 由训练数据计算probe函数, merge 合并多个build的输出,
+	concat 由数据文件生成draw.py评分与作图使用的concat文件,
+	factorize 对probe函数作低秩分解, sweep 构建并评分一组分箱参数。
+
+	build 的功能：
+	1. 解析命令行参数，获取输入的几何文件、训练数据文件、输出文件路径、空间和时间的分箱数。
 	2. 读取几何文件，提取PMT的球坐标角度θ和φ。
-	3. 依次读取每个训练数据文件，计算各顶点和PMT的相对位置和对应的r和θ值。
-	4. 统计每个(r, θ, t)组合出现的次数，并对所有训练文件进行累加。
-	5. 将累加的探测器响应函数存储为HDF5格式，并将分箱信息作为属性保存。
+	3. 将各训练数据文件按顶点划分为若干段，由多个进程并行计算各顶点和PMT的相对位置和对应的r和θ值。
+	4. 统计每个(r, θ, t)组合出现的PE数目和[顶点, PMT]对的数目，逐个累加各进程返回的部分和。
+	5. 将PE数目(Counts)、[顶点, PMT]对数目(Exposure)以及二者之比得到的探测器响应函数(Probe)
+	   存储为HDF5格式，并将分箱信息作为属性保存。空格子只在最后计算Probe时填充。
+
+	merge 将多个build输出中的Counts与Exposure分别相加后重新计算Probe，
+	因此可以在不同机器或不同时间分批计算训练集，再合并为一个结果。
+	未给出`--fill`时沿用build记录的填充方式，各输入的填充方式不同时报错。
+
+	factorize 将probe函数分解为R(r, θ, t) ≈ Σ_k a_k(r, θ)·b_k(t)，a_k与b_k非负，
+	并打印截断SVD的解释方差曲线与各秩相对完整probe表的存储比例k(B²+T)/(B²T)，
+	用于在评分与内存之间选择秩。分解存储为Spatial与Temporal，probe.py读到时以分解求值：
+	μ为空间因子与时间因子积分的点积，光变曲线为k项之和。build与merge也可以由`--rank`直接写入分解。
+
+	sweep 在`-b`、`--theta-bins`、`-t`与`--fill`给出的所有组合上构建均匀分箱的probe函数，
+	并在`--concat`给出的留出数据上评分。训练数据的几何计算结果写入几何缓存(默认为
+	histogram_cache)，所有组合的直方图在同一遍读取缓存时统计；concat文件只读取一次，
+	转换为缓存目录中的内存映射数组，由各进程并行评分。评分与draw.py validate相同，
+	但不再检查一致性。`--binned`时由concat文件在`--grid`上预先统计的PE与[顶点, PMT]对数目评分，
+	每个组合只需对格子求和(见coefficient.py的SufficientStatistics)。输出每个组合的评分、构建耗时、查表评分耗时与probe表大小，
+	`-o`给出时写为CSV，`--tables`给出时保留各组合的probe表。
+
+	concat 逐块读取数据文件，按(EventID, ChannelID)将PE对应到顶点与PMT，
+	写出每个PE的(r, θ, t)(数据集Concat)和每个[顶点, PMT]对的(r, θ)(数据集Vertices)。
+	各文件的顶点块由多个进程并行计算，内存占用只取决于`--max-memory`与进程数。
 
 	参数：
 	- `-g, --geo`: 几何文件路径（HDF5格式），包含PMT的球坐标角度信息。
-	- `--data`: 训练数据文件夹路径，包含多个训练数据文件（HDF5格式）。
+	- `--data`: 训练数据文件（HDF5格式），可以给出多个文件、通配符或文件夹。
 	- `-o, --output`: 输出文件路径（HDF5格式），用于保存计算得到的探测器响应函数。
 	- `-b, --bins`: 空间分箱数，用于对r和θ进行分箱。
+	- `--theta-bins`: θ的分箱数，默认与`--bins`相同。
 	- `-t, --tbins`: 时间分箱数，用于对时间t进行分箱。
+	- `--max-memory`: 每个进程几何计算的内存上限(MB)，据此确定每块的顶点数目。
+	- `--chunk`: 几何计算每块的顶点数目，给定时覆盖`--max-memory`。
+	- `--cache`: 几何缓存目录。给定时各文件的几何计算结果会被缓存，
+	  只改变分箱数的重复运行不再重新计算三角函数。
+	- `--verify-cache`: 用每个文件的前一块顶点重新计算几何, 检查缓存与直接计算落入相同的格子。
+	- `-j, --jobs`: 并行进程数，默认为CPU核数。
+	- `--fill`: 空格子的填充方式，`mean`为同一t格子中其余元素的平均值(均匀分箱的默认值)，
+	  `none`保留零值，`half`将没有PE的格子视为有0.5个PE(自适应分箱的默认值)。
+	- `--binning`: 分箱方式，`uniform`在r³、cosθ与t上均匀分箱(默认)；`adaptive`先统计PE在
+	  r³、1-cosθ与t上的分布，取其与均匀曝光分布混合后的分位数作为格子边界，PE密集的区域
+	  (靠近液闪边缘、较早的时间)格子更细。边界落在均匀查找表格子上，查找表随Probe一起保存，
+	  probe.py仍以常数时间查表。格子边界由数据决定，分别build的输出不能merge。
+	- `-k, --rank`: 低秩分解的秩，build与merge中默认不分解，factorize中不给出时只打印曲线。
+	- `--profile`: 各阶段耗时报告文件(.json或.csv)，也可以由环境变量`JUNOPROBE_PROFILE`给出。
+	- `--profile-stage`: 用cProfile与tracemalloc分析的阶段名称。
 
 	输入：
 	- 几何文件（HDF5格式）：包含PMT的球坐标角度信息（θ和φ）。
@@ -102,42 +999,119 @@ def main():
 
 	示例用法：
 	```bash
-	./histogram.py -g geometry.h5 --data data_folder -o output_probe.h5 -b 20 -t 100
+	./histogram.py build -g geometry.h5 --data data_folder/*.h5 -o output_probe.h5 -b 20 -t 100 -j 20
+	./histogram.py merge part1.h5 part2.h5 -o output_probe.h5
+	./histogram.py factorize output_probe.h5 -k 4 -o output_probe_k4.h5
+	./histogram.py sweep -g geometry.h5 --data data_folder --concat concat.h5 -b 10 20 -t 10 50 100 --fill mean half -o sweep.csv
+	./histogram.py concat -g geometry.h5 --data test_folder -o concat.h5 -j 20
 	```
     """
 
     # Argument parsing
     psr = argparse.ArgumentParser()
-    psr.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
-    psr.add_argument("--data", dest="data", type=str, help="training data")
-    psr.add_argument("-o", "--output", dest="opt", type=str, help="output file")
-    psr.add_argument("-b", "--bins", dest="Bins", type=str, help="output file")
-    psr.add_argument("-t", "--tbins", dest="T_Bins", type=str, help="output file")
-    args = psr.parse_args()
+    subparsers = psr.add_subparsers(dest="command", required=True)
 
-    # read geometry data
-    with h5py.File(args.geo, 'r') as h5file_r:
-        geo = h5file_r["Geometry"][...]
-    geo_theta = np.deg2rad(geo["theta"][None, :N])
-    geo_phi = np.deg2rad(geo["phi"][None, :N])
+    psr_build = subparsers.add_parser("build", help="build the probe from training data")
+    psr_build.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
+    psr_build.add_argument("--data", dest="data", type=str, nargs="+",
+                           help="training data files, globs or folders")
+    psr_build.add_argument("-o", "--output", dest="opt", type=str, help="output file")
+    psr_build.add_argument("-b", "--bins", dest="Bins", type=str, help="output file")
+    psr_build.add_argument("-t", "--tbins", dest="T_Bins", type=str, help="output file")
+    psr_build.add_argument("--theta-bins", dest="theta_bins", type=int, default=None,
+                           help="θ bins, by default as --bins")
+    psr_build.add_argument("--max-memory", dest="max_memory", type=float, default=1024,
+                           help="memory limit of the geometry stage per worker (MB)")
+    psr_build.add_argument("--chunk", dest="chunk", type=int, default=None,
+                           help="vertices per geometry chunk, overrides --max-memory")
+    psr_build.add_argument("--cache", dest="cache", type=str, default=None,
+                           help="geometry cache directory")
+    psr_build.add_argument("--verify-cache", dest="verify_cache", action="store_true",
+                           help="recompute the first chunk of every file to check the cache")
+    psr_build.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                           help="number of worker processes")
+    psr_build.add_argument("--fill", dest="fill", choices=FILL, default=None,
+                           help="fill policy of empty bins, by default mean for "
+                                "uniform and half for adaptive binning")
+    psr_build.add_argument("--binning", dest="binning", choices=BINNING, default="uniform",
+                           help="uniform bins, or equal-statistics bins from the PEs")
 
-    r_bins = (np.arange(int(args.Bins)+1) / int(args.Bins)) ** (1/3)
-    theta_bins = np.arccos(np.arange(int(args.Bins)+1) / int(args.Bins))[::-1]
+    psr_merge = subparsers.add_parser("merge", help="merge the outputs of build")
+    psr_merge.add_argument("inputs", type=str, nargs="+", help="files to merge")
+    psr_merge.add_argument("-o", "--output", dest="opt", type=str, help="output file")
+    psr_merge.add_argument("--fill", dest="fill", choices=FILL, default=None,
+                           help="fill policy of empty bins, by default as recorded in the inputs")
+    psr_factorize = subparsers.add_parser("factorize", help="factorize the probe")
+    psr_factorize.add_argument("input", type=str, help="output of build or merge")
+    psr_factorize.add_argument("-o", "--output", dest="opt", type=str, default=None,
+                               help="output file, by default the input is updated")
+    for subparser in (psr_build, psr_merge, psr_factorize):
+        subparser.add_argument("-k", "--rank", dest="rank", type=int, default=None,
+                               help="rank of the factorized probe")
 
-    with Pool(processes=20) as pool:
-        probe = np.sum(np.array(pool.map(get_probe,
-            zip(Seq, zip([args.data]*N0, [int(args.Bins)]*N0,
-            [int(args.T_Bins)]*N0, [r_bins]*N0, [theta_bins]*N0),
-            [geo_theta]*N0, [geo_phi]*N0))), axis=0)
+    psr_sweep = subparsers.add_parser("sweep", help="build and score a grid of binnings")
+    psr_sweep.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
+    psr_sweep.add_argument("--data", dest="data", type=str, nargs="+",
+                           help="training data files, globs or folders")
+    psr_sweep.add_argument("--concat", dest="concat", type=str,
+                           help="held-out concat file to score on")
+    psr_sweep.add_argument("-b", "--bins", dest="bins", type=int, nargs="+", default=[10],
+                           help="r bins to try")
+    psr_sweep.add_argument("--theta-bins", dest="theta_bins", type=int, nargs="+",
+                           default=None, help="θ bins to try, by default as --bins")
+    psr_sweep.add_argument("-t", "--tbins", dest="tbins", type=int, nargs="+",
+                           default=[10], help="t bins to try")
+    psr_sweep.add_argument("--fill", dest="fill", choices=FILL, nargs="+",
+                           default=["mean"], help="fill policies of empty bins to try")
+    psr_sweep.add_argument("-o", "--output", dest="opt", type=str, default=None,
+                           help="CSV table of the results")
+    psr_sweep.add_argument("--tables", dest="tables", type=str, default=None,
+                           help="directory to keep the probe tables in")
+    psr_sweep.add_argument("--max-memory", dest="max_memory", type=float, default=1024,
+                           help="memory limit of the geometry stage per worker (MB)")
+    psr_sweep.add_argument("--chunk", dest="chunk", type=int, default=None,
+                           help="vertices per geometry chunk, overrides --max-memory")
+    psr_sweep.add_argument("--cache", dest="cache", type=str, default=SWEEP_CACHE,
+                           help="geometry cache directory")
+    psr_sweep.add_argument("--binned", dest="binned", action="store_true",
+                           help="score from pre-binned counts of the concat file")
+    psr_sweep.add_argument("--grid", dest="grid", type=int, nargs=3,
+                           default=STATISTICS_GRID,
+                           help="cells of the pre-binned counts in r³, 1-cosθ and t")
+    psr_sweep.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                           help="number of worker processes")
 
-    probe = probe / N0 * int(args.T_Bins) / T_max
+    psr_concat = subparsers.add_parser("concat", help="write a concat file for scoring")
+    psr_concat.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
+    psr_concat.add_argument("--data", dest="data", type=str, nargs="+",
+                            help="data files, globs or folders")
+    psr_concat.add_argument("-o", "--output", dest="opt", type=str, help="output file")
+    psr_concat.add_argument("--max-memory", dest="max_memory", type=float, default=1024,
+                            help="memory limit per chunk of vertices (MB)")
+    psr_concat.add_argument("--chunk", dest="chunk", type=int, default=None,
+                            help="vertices per chunk, overrides --max-memory")
+    psr_concat.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                            help="number of worker processes")
 
-    with h5py.File(args.opt, 'w') as h5file_w:
-        dataset = h5file_w.create_dataset('Probe', data=probe)
-        dataset.attrs['Bins'] = int(args.Bins)
-        dataset.attrs['T_Bins'] = int(args.T_Bins)
-        dataset.attrs['R_Bins'] = r_bins
-        dataset.attrs['Theta_Bins'] = theta_bins
+    for subparser in (psr_build, psr_merge, psr_factorize, psr_sweep, psr_concat):
+        subparser.add_argument("--profile", dest="profile", type=str, default=None,
+                               help="write a stage timing report (.json or .csv)")
+        subparser.add_argument("--profile-stage", dest="profile_stage", type=str,
+                               default=None, help="run one stage under cProfile")
+    args = psr.parse_args()
+    if args.profile is not None:
+        profiling.enable(args.profile, args.profile_stage)
+
+    if args.command == "build":
+        build(args)
+    elif args.command == "merge":
+        merge(args)
+    elif args.command == "factorize":
+        low_rank(args)
+    elif args.command == "sweep":
+        sweep(args)
+    elif args.command == "concat":
+        concat(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,213 @@
+'''
+Lightweight stage timing for histogram.py, probe.py, coefficient.py and draw.py.
+
+Code is instrumented with named spans::
+
+    with profiling.span("histogram.read", items=len(rows)):
+        ...
+
+When profiling is disabled, `span` returns a shared no-op context manager and
+costs a single attribute check. It is enabled by the ``JUNOPROBE_PROFILE``
+environment variable, or by the ``--profile`` flag of histogram.py and
+draw.py, both naming the report file. Per span name the report has the number
+of calls, the wall time, the items processed and the peak RSS of the process.
+A ``.csv`` report is appended to with a timestamp per run, like the
+``JUNOPROBE_SCORE`` log; other reports are written as JSON.
+
+``JUNOPROBE_PROFILE_STAGE`` (or ``--profile-stage``) names one span to run
+under cProfile and tracemalloc. The cProfile statistics are dumped next to
+the report as ``<report>.<stage>.<pid>.prof``, accumulated over all calls of
+the span in the process, and the traced peak memory of the
+span is added to its report row.
+'''
+
+import atexit
+import cProfile
+import csv
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# 报告文件路径的环境变量
+PROFILE_ENV = "JUNOPROBE_PROFILE"
+# 用cProfile与tracemalloc分析的阶段名称的环境变量
+STAGE_ENV = "JUNOPROBE_PROFILE_STAGE"
+
+# 报告文件路径, 为None时不记录
+report_file = os.environ.get(PROFILE_ENV)
+# 用cProfile与tracemalloc分析的阶段名称
+profile_stage = os.environ.get(STAGE_ENV)
+# 各阶段的统计, 以阶段名称为键
+records = {}
+# records所属的进程号, fork出的子进程不沿用父进程的统计
+_owner = os.getpid()
+
+# CSV报告的列
+FIELDS = ["time", "stage", "calls", "seconds", "items", "throughput",
+          "maxrss_mb", "peak_mb"]
+
+_lock = threading.Lock()
+_null = nullcontext()
+_registered = False
+# 本进程中累计分析profile_stage的cProfile对象, 以(进程号, 对象)保存
+_profiler = (None, None)
+
+def register():
+    '''
+    Write the report at exit, once per process.
+    '''
+    global _registered
+    if not _registered:
+        _registered = True
+        atexit.register(write_report)
+
+def enable(filename, stage=None):
+    '''
+    Enable profiling and write the report to `filename` at exit.
+    The setting is exported to the environment, so worker processes inherit it.
+    '''
+    global report_file, profile_stage
+    report_file = filename
+    os.environ[PROFILE_ENV] = filename
+    if stage is not None:
+        profile_stage = stage
+        os.environ[STAGE_ENV] = stage
+    register()
+
+def own():
+    '''
+    Clear the records inherited from the parent in a forked process.
+    Must be called with `_lock` held.
+    '''
+    global _owner
+    if _owner != os.getpid():
+        _owner = os.getpid()
+        records.clear()
+
+def add(name, seconds, items=0, calls=1, peak_mb=None):
+    '''
+    Add a measurement of the stage `name` to `records`.
+    '''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with _lock:
+        own()
+        record = records.setdefault(name, {"stage": name, "calls": 0, "seconds": 0.0,
+                                           "items": 0, "maxrss_mb": 0.0,
+                                           "peak_mb": None})
+        record["calls"] += calls
+        record["seconds"] += seconds
+        record["items"] += int(items)
+        record["maxrss_mb"] = max(record["maxrss_mb"], maxrss)
+        if peak_mb is not None:
+            record["peak_mb"] = max(record["peak_mb"] or 0, peak_mb)
+
+class Span:
+    '''
+    Time a stage and add it to `records`, see `span`.
+    '''
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+        self.profiler = None
+
+    def __enter__(self):
+        global _profiler
+        if self.name == profile_stage:
+            # fork出的子进程不沿用父进程的统计
+            if _profiler[0] != os.getpid():
+                _profiler = (os.getpid(), cProfile.Profile())
+            tracemalloc.start()
+            self.profiler = _profiler[1]
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            self.profiler.dump_stats(f"{report_file}.{self.name}.{os.getpid()}.prof")
+        add(self.name, seconds, self.items, peak_mb=peak)
+        return False
+
+def span(name, items=0):
+    '''
+    Return a context manager timing the stage `name`, which processes `items`.
+    '''
+    if report_file is None:
+        return _null
+    return Span(name, items)
+
+def collect():
+    '''
+    Return and clear the records of this process, to be merged by `merge`
+    in the parent process.
+    '''
+    with _lock:
+        own()
+        result = list(records.values())
+        records.clear()
+    return result
+
+def merge(rows):
+    '''
+    Merge records returned by `collect` in another process.
+    '''
+    for row in rows:
+        add(row["stage"], row["seconds"], row["items"], row["calls"], row["peak_mb"])
+
+class Traced:
+    '''
+    Wrap a function run by a process pool so that the records of the worker
+    are returned with its result. The parent unpacks them with `unpack`.
+    '''
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        result = self.func(*args)
+        return result, collect() if report_file is not None else []
+
+def unpack(item):
+    '''
+    Merge the worker records of a `Traced` result and return the result.
+    '''
+    result, rows = item
+    merge(rows)
+    return result
+
+def write_report(filename=None):
+    '''
+    Write the records to `filename` (by default the report file) as JSON,
+    or append them as CSV when `filename` ends with ``.csv``.
+    '''
+    filename = report_file if filename is None else filename
+    if filename is None:
+        return
+    rows = list(records.values())
+    now = time.time()
+    rows = [{**row, "time": now,
+             "throughput": row["items"] / row["seconds"] if row["seconds"] else None}
+            for row in rows]
+    if filename.endswith(".csv"):
+        new = not os.path.exists(filename)
+        with open(filename, "a", newline="") as report:
+            writer = csv.DictWriter(report, fieldnames=FIELDS)
+            if new:
+                writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(filename, "w") as report:
+            json.dump(rows, report, indent=2)
+
+if report_file is not None:
+    register()
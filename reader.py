@@ -0,0 +1,222 @@
+'''
+Chunked reader of the training and data files.
+
+`PETruth` is a compound dataset, and slicing it reads every field, including
+`LightTime` which is never used. `EventReader` reads only `EventID`,
+`ChannelID` and the time column, and only the rows of the requested vertices.
+The time column is `HitTime` in the README and `PETime` in the files the probe
+was developed on. It is resolved from the dtype by `time_field`.
+
+`prefetch` runs an iterator on a background thread, so the next chunk is read
+while the current one is processed. h5py releases the GIL while reading, so
+the read latency of a network filesystem is hidden behind the binning.
+'''
+
+import os
+import queue
+import threading
+import h5py
+import numpy as np
+
+import profiling
+
+# PMT数量
+N = 17612
+# 液闪区域半径(mm)
+R0 = 17710
+# PETruth中时间字段的可能名称, 按优先顺序排列
+TIME_FIELDS = ("PETime", "HitTime")
+# 扫描EventID时每次读取的行数
+SCAN_ROWS = 2**20
+# 后台线程预读的块数
+PREFETCH = 1
+
+def time_field(dtype):
+    '''
+    Return the name of the PE time field of a `PETruth` dtype.
+    '''
+    for name in TIME_FIELDS:
+        if name in dtype.names:
+            return name
+    raise ValueError(f"PETruth has none of the time fields {TIME_FIELDS}: {dtype.names}")
+
+class EventReader:
+    '''
+    Read the vertices of a data file and their PEs by ranges of vertices.
+
+    On opening, the `EventID` column of `PETruth` is scanned once in blocks
+    of `SCAN_ROWS` rows. When the PEs are sorted by `EventID`, as in the
+    official files, this gives the PE rows of every vertex, and a range of
+    vertices only reads its own PEs. Otherwise the scan also builds the PE
+    rows of every vertex, `rows`, and a range of vertices reads the blocks of
+    `SCAN_ROWS` rows that hold its PEs.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with h5py.File(filename, 'r') as h5file_r:
+            particle = h5file_r["ParticleTruth"]
+            pe = h5file_r["PETruth"]
+            self.time = time_field(pe.dtype)
+            self.event_id = particle.fields("EventID")[...]
+            self.n = len(self.event_id)
+            self.n_pe = len(pe)
+            with profiling.span("reader.scan", self.n_pe):
+                self.offset, self.rows = self.scan(pe.fields("EventID"))
+
+    def scan(self, event_column):
+        '''
+        Return the offset of the PEs of every vertex (length n + 1) and the PE
+        rows they refer to.
+
+        When the PEs are sorted by EventID, the offsets are PE rows and the
+        rows are None. Otherwise the rows are the PE rows ordered by vertex,
+        and the PEs of the vertices `start` to `stop` are
+        ``rows[offset[start]:offset[stop]]``.
+        '''
+        left = np.zeros(self.n + 1, dtype=np.int64)
+        previous = None
+        # PE按EventID排列之前为None, 否则为各块PE对应的顶点序号
+        vertices = None
+        for start in range(0, self.n_pe, SCAN_ROWS):
+            block = event_column[start:start+SCAN_ROWS]
+            if vertices is None and (
+                    np.any(block[1:] < block[:-1])
+                    or (previous is not None and len(block) and block[0] < previous)):
+                # 之前的块只需要补充顶点序号, 不再重新检查
+                vertices = [self.vertices(event_column[lo:min(lo + SCAN_ROWS, start)])
+                            for lo in range(0, start, SCAN_ROWS)]
+            if vertices is not None:
+                vertices.append(self.vertices(block))
+                continue
+            if len(block):
+                previous = block[-1]
+            # 各块中EventID小于每个顶点的PE数目之和, 即该顶点的第一个PE所在的行
+            left[:-1] += np.searchsorted(block, self.event_id)
+            if self.n:
+                left[-1] += np.searchsorted(block, self.event_id[-1], side='right')
+        if vertices is None:
+            return left, None
+        vertices = np.concatenate(vertices)
+        rows = np.argsort(vertices, kind='stable')
+        return np.searchsorted(vertices[rows], np.arange(self.n + 1)), rows
+
+    def vertices(self, block):
+        '''
+        Return the vertex of every PE of a block of the EventID column, or n
+        for PEs after the last vertex. PEs of other events are dropped by `read`.
+        '''
+        return np.searchsorted(self.event_id, block).astype(
+            np.int32 if self.n < 2**31 else np.int64)
+
+    @staticmethod
+    def take(dataset, rows):
+        '''
+        Read the sorted `rows` of `dataset`, one block of `SCAN_ROWS` rows at a
+        time, so that only the blocks holding `rows` are read.
+        '''
+        blocks = np.split(rows, np.flatnonzero(np.diff(rows // SCAN_ROWS)) + 1)
+        return np.concatenate([dataset[block[0]:block[-1]+1][block - block[0]]
+                               for block in blocks if len(block)] or [dataset[0:0]])
+
+    def read(self, start=0, stop=None):
+        '''
+        Return the vertices `start` to `stop` and their PEs, see
+        `histogram.read_events`.
+        '''
+        stop = self.n if stop is None else min(stop, self.n)
+        fields = ["EventID", "ChannelID", self.time]
+        with h5py.File(self.filename, 'r') as h5file_r:
+            particle = h5file_r["ParticleTruth"].fields(["EventID", "x", "y", "z"])
+            ParticleTruth = particle[start:stop]
+            PETruth = h5file_r["PETruth"].fields(fields)
+            if len(ParticleTruth) == 0:
+                PETruth = PETruth[0:0]
+            elif self.rows is None:
+                # PE按EventID排列时只读取该顶点范围内的PE
+                PETruth = PETruth[self.offset[start]:self.offset[stop]]
+            else:
+                PETruth = self.take(PETruth,
+                                    np.sort(self.rows[self.offset[start]:self.offset[stop]]))
+
+        # 计算各顶点的归一化位置
+        vertex = np.stack([ParticleTruth['x'], ParticleTruth['y'],
+                           ParticleTruth['z']], axis=1) / R0
+
+        event = np.searchsorted(ParticleTruth['EventID'], PETruth['EventID'])
+        channel = PETruth['ChannelID']
+        hit = ((event < len(ParticleTruth)) & (channel >= 0) & (channel < N))
+        hit[hit] = ParticleTruth['EventID'][event[hit]] == PETruth['EventID'][hit]
+        order = np.argsort(event[hit], kind='stable')
+        event, channel = event[hit][order], channel[hit][order]
+        offset = np.searchsorted(event, np.arange(len(ParticleTruth) + 1))
+        return vertex, event, channel, PETruth[self.time][hit][order], offset
+
+    def chunks(self, start=0, stop=None, chunk=None):
+        '''
+        Iterate over `read` of the vertices `start` to `stop` in chunks of
+        `chunk` vertices, yielding (first vertex of the chunk, result of `read`).
+        '''
+        stop = self.n if stop is None else min(stop, self.n)
+        chunk = max(stop - start, 1) if chunk is None else chunk
+        for lo in range(start, stop, chunk):
+            with profiling.span("reader.read", min(lo + chunk, stop) - lo):
+                events = self.read(lo, min(lo + chunk, stop))
+            yield lo, events
+
+# 本进程中已经打开的文件, 以(文件的绝对路径, 修改时间)为键
+readers = {}
+
+def get_reader(filename):
+    '''
+    Return the `EventReader` of `filename`, scanning it only once per process
+    unless the file has been modified since.
+    '''
+    path = os.path.realpath(filename)
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in readers:
+        for stale in [k for k in readers if k[0] == path]:
+            del readers[stale]
+        readers[key] = EventReader(path)
+    return readers[key]
+
+def prefetch(iterable, depth=PREFETCH):
+    '''
+    Iterate over `iterable` on a background thread, at most `depth` items
+    ahead of the caller. Exceptions of the thread are raised in the caller.
+    '''
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        # 调用者提前结束时不再阻塞, 返回False
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as error:
+            put((end, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,274 @@
+'''
+Reconstruct the vertices of events from their PEs with a probe.
+
+For a candidate vertex v (in units of R0) the Poisson log-likelihood of an
+event is the score of coefficient.py restricted to the event:
+
+    log L(v) = Σ_PE log R(|v|, θ_PE, t_PE) - Σ_PMT μ(|v|, θ_PMT),
+
+where θ is the angle between v and the PMT. Only the `ProbeBase` interface is
+used, so any probe can be plugged in.
+
+The second sum runs over all PMTs but does not depend on the event. It is
+computed once for the points of a cubic grid inside the liquid scintillator,
+so scanning the grid only costs the hit PMTs of an event. Batches of events
+are scanned in vectorized form. The best grid points are then refined by a
+pattern search whose step halves down to `MIN_STEP`. During refinement the
+sum is computed exactly, because interpolating it between grid points has
+errors of several units of log-likelihood near the edge, where μ changes
+sharply. Events are spread over a process pool.
+
+```bash
+python3 reconstruct.py -g geo.h5 --data data/16001.h5 --probe histogram.h5 -o rec.h5 -j 4
+```
+'''
+
+import argparse
+import math
+import os
+import time
+from multiprocessing import Pool
+import h5py
+import numpy as np
+
+import histogram
+import profiling
+import reader
+from probe import Probe
+
+# 液闪区域半径(mm)
+R0 = 17710
+# 粗扫描的格点间距(以R0为单位)
+GRID_STEP = 0.2
+# 局部细化的最小步长(以R0为单位)
+MIN_STEP = 1e-3
+# 每个事件从粗扫描中似然最大的STARTS个格点开始细化
+STARTS = 1
+# 局部细化的最大迭代次数
+MAX_ITERATIONS = 200
+# 每块计算的[PE, 候选顶点]对或[候选顶点, PMT]对数目
+CHUNK = 2**20
+# 每批一起计算的事件数目
+BATCH = 64
+# 局部细化的搜索方向
+DIRECTIONS = np.concatenate([np.eye(3), -np.eye(3)])
+# 输出文件中重建结果的数据类型, 坐标单位为mm
+RECONSTRUCTION_DTYPE = np.dtype([('EventID', '<i4'), ('x', '<f8'), ('y', '<f8'),
+                                 ('z', '<f8'), ('LogLikelihood', '<f8')])
+
+def get_rtheta(vertices, pmt):
+    '''
+    Return (r, θ) of `vertices` relative to the PMT unit vectors `pmt`,
+    broadcast against each other along the last axis.
+    '''
+    r = np.sqrt(np.sum(vertices**2, axis=-1))
+    cos = np.sum(vertices * pmt, axis=-1) / np.maximum(r, np.finfo(np.float64).tiny)
+    return r, np.arccos(np.clip(cos, -1, 1))
+
+def sum_mu(probe, vertices, pmt):
+    '''
+    Return Σ_PMT μ of every vertex in `vertices` with shape (n, 3).
+    Vertices outside the liquid scintillator are moved onto its surface.
+    '''
+    block = max(CHUNK // len(pmt), 1)
+    mu = np.empty(len(vertices))
+    for i in range(0, len(vertices), block):
+        r = np.sqrt(np.sum(vertices[i:i+block]**2, axis=1))
+        cos = (vertices[i:i+block] @ pmt.T) / np.maximum(r, np.finfo(np.float64).tiny)[:, None]
+        theta = np.arccos(np.clip(cos, -1, 1))
+        mu[i:i+block] = np.sum(probe.get_mu(np.broadcast_to(np.minimum(r, 1)[:, None],
+                                                             theta.shape), theta), axis=1)
+    return mu
+
+def sum_by_event(values, event, n_events):
+    '''
+    Sum the rows of `values` belonging to each event. `event` is sorted.
+    '''
+    result = np.zeros((n_events,) + values.shape[1:])
+    if len(event):
+        # 每段连续的同一事件的PE一起求和, 各段的事件互不相同
+        start = np.flatnonzero(np.r_[True, event[1:] != event[:-1]])
+        result[event[start]] += np.add.reduceat(values, start, axis=0)
+    return result
+
+class Reconstructor:
+    '''
+    Reconstruct vertices with `probe` for the PMT unit vectors `pmt`.
+
+    The coarse scan uses the points of a cubic grid of spacing `step` inside
+    the liquid scintillator, including the center. Σ_PMT μ of these points is
+    computed once.
+    '''
+
+    def __init__(self, probe, pmt, step=GRID_STEP):
+        self.probe = probe
+        self.pmt = pmt
+        axis = np.arange(-math.floor(1 / step), math.floor(1 / step) + 1) * step
+        grid = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+        self.scan = grid[np.sum(grid**2, axis=1) < 1]
+        with profiling.span("reconstruct.grid", len(self.scan) * len(pmt)):
+            self.scan_mu = sum_mu(probe, self.scan, pmt)
+        self.refine_step = step / 2
+
+    def log_likelihood(self, candidates, event, channel, t, n_events):
+        '''
+        Return the log-likelihood of candidate vertices, with shape (n_events, K).
+
+        `candidates` has shape (K, 3) when shared by all events, or
+        (n_events, K, 3). `event`, `channel` and `t` describe the PEs,
+        sorted by `event`.
+        '''
+        shared = candidates.ndim == 2
+        n_candidates = candidates.shape[-2]
+        block = max(CHUNK // n_candidates, 1)
+        hit = np.zeros((n_events, n_candidates))
+        for i in range(0, len(event), block):
+            pmt = self.pmt[channel[i:i+block], None, :]
+            vertices = candidates[None] if shared else candidates[event[i:i+block]]
+            r, theta = get_rtheta(vertices, pmt)
+            ts = np.broadcast_to(t[i:i+block, None], theta.shape)
+            rs = np.broadcast_to(np.minimum(r, 1), theta.shape)
+            log_lc = self.probe.get_log_lc(rs.ravel(), theta.ravel(),
+                                           ts.ravel()).reshape(theta.shape)
+            hit += sum_by_event(log_lc, event[i:i+block], n_events)
+        if shared:
+            return hit - self.scan_mu
+        outside = np.sum(candidates**2, axis=-1) >= 1
+        mu = sum_mu(self.probe, candidates.reshape(-1, 3), self.pmt).reshape(outside.shape)
+        return np.where(outside, -np.inf, hit - mu)
+
+    def reconstruct(self, event, channel, t, n_events, starts=STARTS):
+        '''
+        Return the reconstructed vertices (in units of R0) and their
+        log-likelihood for a batch of `n_events` events.
+
+        The `starts` best scan candidates of every event are refined, and the
+        best refined vertex is returned.
+        '''
+        with profiling.span("reconstruct.scan", len(event) * len(self.scan)):
+            likelihood = self.log_likelihood(self.scan, event, channel, t, n_events)
+            best = np.argsort(-likelihood, axis=1)[:, :starts]
+            vertices = self.scan[best]
+            likelihood = np.take_along_axis(likelihood, best, axis=1)
+
+        with profiling.span("reconstruct.refine", n_events):
+            step = np.full(vertices.shape[:2], self.refine_step)
+            for _ in range(MAX_ITERATIONS):
+                active = step >= MIN_STEP
+                # 只计算仍在细化的事件的PE, 事件重新编号
+                index = np.flatnonzero(np.any(active, axis=1))
+                if len(index) == 0:
+                    break
+                pe = np.any(active, axis=1)[event]
+                renumber = np.cumsum(np.any(active, axis=1)) - 1
+                # (事件, 起点, 方向)
+                candidates = (vertices[index, :, None, :]
+                              + step[index, :, None, None] * DIRECTIONS)
+                around = self.log_likelihood(candidates.reshape(len(index), -1, 3),
+                                             renumber[event[pe]], channel[pe], t[pe],
+                                             len(index)).reshape(candidates.shape[:3])
+                k = np.argmax(around, axis=2)
+                top = np.take_along_axis(around, k[:, :, None], axis=2)[:, :, 0]
+                better = (top > likelihood[index]) & active[index]
+                event_better, start_better = np.nonzero(better)
+                moved = index[event_better]
+                vertices[moved, start_better] = candidates[event_better, start_better,
+                                                           k[better]]
+                likelihood[moved, start_better] = top[better]
+                # 周围没有更好的候选顶点时步长减半
+                step[index] = np.where(better | ~active[index], step[index],
+                                       step[index] / 2)
+
+        best = np.argmax(likelihood, axis=1)
+        vertices = vertices[np.arange(n_events), best]
+        likelihood = likelihood[np.arange(n_events), best]
+        return vertices, likelihood
+
+def reconstruct_part(Arguments):
+    '''
+    Reconstruct the vertices `start` to `stop` of a data file in batches.
+    The next batch is read on a background thread.
+
+    Returns the EventID, the true and the reconstructed vertices (mm) and the
+    log-likelihood of every event.
+    '''
+    reconstructor, filename, start, stop, batch, starts = Arguments
+    event_reader = reader.get_reader(filename)
+    truth = np.empty((stop - start, 3))
+    vertices = np.empty((stop - start, 3))
+    likelihood = np.empty(stop - start)
+    for lo, (vertex, event, channel, t, _) in reader.prefetch(
+            event_reader.chunks(start, stop, batch)):
+        i = slice(lo - start, lo - start + len(vertex))
+        truth[i] = vertex
+        vertices[i], likelihood[i] = reconstructor.reconstruct(event, channel, t,
+                                                               len(vertex), starts)
+    return event_reader.event_id[start:stop], truth * R0, vertices * R0, likelihood
+
+def main():
+    '''
+    Reconstruct the vertices of data files and report the events per second.
+
+    The output has a `Reconstruction` dataset with EventID, the vertex in mm
+    and its log-likelihood, in the order of the data files. The distance to
+    the `ParticleTruth` vertices is printed as well.
+    '''
+    psr = argparse.ArgumentParser()
+    psr.add_argument("-g", "--geo", dest="geo", type=str, help="geometry file")
+    psr.add_argument("--data", dest="data", type=str, nargs="+",
+                     help="data files, globs or folders")
+    psr.add_argument("--probe", dest="probe", type=str, default=None,
+                     help="probe table, by default as in probe.py")
+    psr.add_argument("-o", "--output", dest="opt", type=str, default=None,
+                     help="output file")
+    psr.add_argument("--events", dest="events", type=int, default=None,
+                     help="reconstruct only the first events of every file")
+    psr.add_argument("--step", dest="step", type=float, default=GRID_STEP,
+                     help="grid spacing of the coarse scan, in units of R0")
+    psr.add_argument("--starts", dest="starts", type=int, default=STARTS,
+                     help="best grid points refined per event")
+    psr.add_argument("--batch", dest="batch", type=int, default=BATCH,
+                     help="events per vectorized batch")
+    psr.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                     help="number of worker processes")
+    psr.add_argument("--profile", dest="profile", type=str, default=None,
+                     help="write a stage timing report (.json or .csv)")
+    psr.add_argument("--profile-stage", dest="profile_stage", type=str, default=None,
+                     help="run one stage under cProfile")
+    args = psr.parse_args()
+    if args.profile is not None:
+        profiling.enable(args.profile, args.profile_stage)
+
+    reconstructor = Reconstructor(Probe(args.probe), histogram.read_pmt(args.geo),
+                                  args.step)
+
+    tasks = []
+    for filename, lo, hi in histogram.get_tasks(histogram.get_files(args.data), args.jobs):
+        if args.events is not None:
+            hi = min(hi, args.events)
+        if lo < hi:
+            tasks.append((reconstructor, filename, lo, hi, args.batch, args.starts))
+
+    start = time.perf_counter()
+    with Pool(processes=args.jobs) as pool:
+        parts = [profiling.unpack(part) for part in
+                 pool.imap(profiling.Traced(reconstruct_part), tasks)]
+    seconds = time.perf_counter() - start
+    event_id, truth, vertices, likelihood = (np.concatenate(a) for a in zip(*parts))
+    print(f"{len(event_id)} events in {seconds:.1f} s, "
+          f"{len(event_id) / seconds:.1f} events/s with {args.jobs} processes")
+    distance = np.sqrt(np.sum((vertices - truth)**2, axis=1))
+    if len(distance):
+        print(f"distance to truth: mean {distance.mean():.1f} mm, "
+              f"median {np.median(distance):.1f} mm")
+
+    if args.opt is not None:
+        result = np.empty(len(event_id), dtype=RECONSTRUCTION_DTYPE)
+        result['EventID'] = event_id
+        result['x'], result['y'], result['z'] = vertices.T
+        result['LogLikelihood'] = likelihood
+        with h5py.File(args.opt, 'w') as h5file_w:
+            h5file_w.create_dataset('Reconstruction', data=result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Score a probe on a concat file without the plotting stack of draw.py.
+
+`draw.py validate` imports matplotlib and configures LaTeX before it scores.
+This entry point only imports numpy and h5py, and only when they are needed.
+
+It can also run a scoring server, which keeps the concat file and the probe
+tables resident. The server listens on a Unix socket or on a localhost port
+and answers JSON requests over HTTP:
+
+- ``POST /score`` with ``{"histogram": path, "binned": bool, "grid": [n_r, n_theta, n_t]}``
+  returns ``{"score": float, "seconds": float, "cached": bool}``, where
+  ``"binned"`` and ``"grid"`` are optional, see `validate`;
+- ``POST /get_mu`` with ``{"histogram": path, "rs": [...], "thetas": [...]}``
+  and ``POST /get_lc`` with ``"ts"`` as well return ``{"values": [...]}``.
+
+A probe table is reloaded when its file changes, and the score of an
+unchanged file is answered from memory. The probe modules `CODE` are
+reloaded when one of their sources changes, which also drops the scores
+cached before the edit, so edits to probe.py are picked up without a restart. With ``--server``, the client only
+sends the path of the histogram file, so it loads neither the concat file
+nor the table.
+
+```bash
+python3 score.py --concat concat.h5
+python3 score.py serve --concat concat.h5 --socket score.sock &
+python3 score.py --server score.sock
+```
+"""
+
+import argparse
+import http.client
+import importlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+import profiling
+
+# The default socket of the server.
+SOCKET = "score.sock"
+# The modules of the probes, in import order, reloaded by the server when
+# their sources change.
+CODE = ("coefficient", "probe", "basis")
+
+
+def histogram_file(filename=None):
+    """The absolute path of the histogram file.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Defaults to ``$JUNOPROBE_HISTOGRAM`` or ``./histogram.h5``.
+    """
+    from probe import HISTOGRAM, HISTOGRAM_ENV
+
+    if filename is None:
+        filename = os.environ.get(HISTOGRAM_ENV, HISTOGRAM)
+    return os.path.abspath(filename)
+
+
+def get_probe(filename=None):
+    """Detemine the right probe from the coefficients.
+
+    Parameters
+    ----------
+    filename : str, optional
+        The histogram file. Defaults to ``$JUNOPROBE_HISTOGRAM`` or ``./histogram.h5``.
+        A file with a ``Coefficients`` dataset is loaded as a `basis.BasisProbe`.
+
+    See Also
+    --------
+    coefficient.ProbeBase
+    """
+    import h5py as h5
+    from basis import BasisProbe
+    from probe import Probe
+
+    filename = histogram_file(filename)
+    with h5.File(filename, "r") as file:
+        if "Coefficients" in file:
+            return BasisProbe(filename)
+    return Probe(filename)
+
+
+def validate(probe, concat, jobs=1, binned=False, grid=None):
+    """Score `probe` on a `coefficient.ConcatInfo`.
+
+    The score does not depend on `jobs`. When `binned`, a piecewise constant
+    probe is scored from the counts of the concat file on `grid`, by default
+    `coefficient.STATISTICS_GRID`.
+
+    See Also
+    --------
+    coefficient.ProbeBase.validate_concat
+    coefficient.ProbeBase.validate_binned
+    """
+    from coefficient import STATISTICS_GRID
+
+    if binned:
+        return probe.validate_binned(concat, grid or STATISTICS_GRID, jobs)
+    return probe.validate_concat(concat, jobs)
+
+
+class Scorer:
+    """The resident state of the server.
+
+    Parameters
+    ----------
+    concat_file : str
+        The concat file, loaded into memory once.
+    jobs : int
+        The number of worker processes of a score.
+    """
+
+    def __init__(self, concat_file, jobs=1):
+        from coefficient import ConcatInfo
+
+        self.concat_file = concat_file
+        self.concat = ConcatInfo(concat_file)
+        self.jobs = jobs
+        # scores by (histogram file, size, mtime, binned, grid)
+        self.scores = {}
+        self.code = self.code_key()
+
+    @staticmethod
+    def key(filename):
+        stat = os.stat(filename)
+        return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def code_key():
+        """The stat of the sources of the modules `CODE`."""
+        for name in CODE:
+            importlib.import_module(name)
+        return tuple(Scorer.key(sys.modules[name].__file__) for name in CODE)
+
+    def reload(self):
+        """Reload the modules `CODE` if one of their sources changed since."""
+        code = self.code_key()
+        if code == self.code:
+            return
+        for name in CODE:
+            importlib.reload(sys.modules[name])
+        from coefficient import ConcatInfo
+
+        # the concat file is kept by an instance of the reloaded class
+        self.concat = ConcatInfo(self.concat_file)
+        self.scores.clear()
+        self.code = code
+
+    def score(self, histogram, binned=False, grid=None):
+        """Score the histogram file, unless it was scored since it or the probe
+        code last changed."""
+        self.reload()
+        grid = None if grid is None else tuple(int(n) for n in grid)
+        key = self.key(histogram) + (binned, grid)
+        cached = key in self.scores
+        start = time.perf_counter()
+        if not cached:
+            for stale in [k for k in self.scores if k[0] == key[0] and k[1:3] != key[1:3]]:
+                del self.scores[stale]
+            # a new probe per file version, `probe.load_table` reloads changed tables
+            probe = get_probe(histogram)
+            self.scores[key] = validate(probe, self.concat, self.jobs, binned, grid)
+        return {
+            "score": self.scores[key],
+            "seconds": time.perf_counter() - start,
+            "cached": cached,
+        }
+
+    def values(self, histogram, rs, thetas, ts=None):
+        """Evaluate `get_mu`, or `get_lc` when `ts` is given, on a batch of points."""
+        import numpy as np
+
+        self.reload()
+        probe = get_probe(histogram)
+        rs, thetas = np.asarray(rs, dtype=np.float64), np.asarray(thetas, dtype=np.float64)
+        if ts is None:
+            values = probe.get_mu(rs, thetas)
+        else:
+            values = probe.get_lc(rs, thetas, np.asarray(ts, dtype=np.float64))
+        return {"values": np.asarray(values, dtype=np.float64).tolist()}
+
+    def handle(self, endpoint, request):
+        """Answer a request to `endpoint`."""
+        histogram = request["histogram"]
+        if endpoint == "score":
+            return self.score(histogram, request.get("binned", False), request.get("grid"))
+        if endpoint == "get_mu":
+            return self.values(histogram, request["rs"], request["thetas"])
+        if endpoint == "get_lc":
+            return self.values(histogram, request["rs"], request["thetas"], request["ts"])
+        raise ValueError(f"unknown endpoint {endpoint}")
+
+
+class Handler(BaseHTTPRequestHandler):
+    """JSON over HTTP for a `Scorer` at ``self.server.scorer``."""
+
+    def do_POST(self):
+        endpoint = self.path.strip("/")
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with profiling.span(f"serve.{endpoint}"):
+                response, status = self.server.scorer.handle(endpoint, request), 200
+        except Exception as error:
+            response, status = {"error": f"{type(error).__name__}: {error}"}, 400
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """`HTTPServer` on a Unix socket."""
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler logs the first element of the client address
+        return request, ("local", 0)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """`http.client.HTTPConnection` to a Unix socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request(server, endpoint, payload):
+    """Send a request to a running server.
+
+    Parameters
+    ----------
+    server : str
+        The Unix socket of the server, or ``http://127.0.0.1:port``.
+    endpoint : str
+        ``"score"``, ``"get_mu"`` or ``"get_lc"``.
+    payload : dict
+        The request, see the module docstring.
+
+    Returns
+    -------
+    dict
+        The response.
+    """
+    if server.startswith("http://"):
+        url = urlsplit(server)
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+    else:
+        connection = UnixHTTPConnection(server)
+    try:
+        connection.request(
+            "POST",
+            f"/{endpoint}",
+            body=json.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+        response = json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response
+
+
+def serve(args):
+    """Run the server until interrupted or terminated."""
+    scorer = Scorer(args.concat, args.jobs)
+    if args.port is not None:
+        server = HTTPServer(("127.0.0.1", args.port), Handler)
+        address = f"http://127.0.0.1:{server.server_port}"
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        address = args.socket
+    server.scorer = scorer
+    # SIGTERM also runs the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"serving {args.concat} on {address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def score(args):
+    """Score a histogram file, locally or by a running server."""
+    if args.server is not None:
+        payload = {
+            "histogram": histogram_file(args.histogram),
+            "binned": args.binned,
+            "grid": args.grid,
+        }
+        s = request(args.server, "score", payload)["score"]
+    else:
+        from coefficient import ConcatInfo
+
+        concat = ConcatInfo(args.concat, stream=True)
+        s = validate(get_probe(args.histogram), concat, args.jobs, args.binned, args.grid)
+    if "JUNOPROBE_SCORE" in os.environ:
+        t = time.time()
+        print(f"{s},{t}")
+        with open(os.environ["JUNOPROBE_SCORE"], mode="a") as file:
+            file.write(f"{s},{t}\n")
+    else:
+        print(s)
+
+
+def main():
+    psr = argparse.ArgumentParser()
+    psr.add_argument(
+        "command", nargs="?", choices=("score", "serve"), default="score", help="command"
+    )
+    psr.add_argument("--concat", dest="concat", type=str, help="concat file")
+    psr.add_argument("--histogram", dest="histogram", type=str, help="histogram file")
+    psr.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1, help="number of processes"
+    )
+    psr.add_argument(
+        "--binned",
+        dest="binned",
+        action="store_true",
+        help="score piecewise constant probes from pre-binned counts",
+    )
+    psr.add_argument(
+        "--grid",
+        dest="grid",
+        type=int,
+        nargs=3,
+        default=None,
+        help="cells of the pre-binned counts in r^3, 1-cos(theta) and t",
+    )
+    psr.add_argument(
+        "--server",
+        dest="server",
+        type=str,
+        help="score by a running server, a Unix socket or http://127.0.0.1:port",
+    )
+    psr.add_argument(
+        "--socket", dest="socket", type=str, default=SOCKET, help="Unix socket to serve on"
+    )
+    psr.add_argument(
+        "--port", dest="port", type=int, help="localhost port to serve on instead of a socket"
+    )
+    psr.add_argument(
+        "--profile", dest="profile", type=str, help="stage timing report (.json or .csv)"
+    )
+    psr.add_argument(
+        "--profile-stage", dest="profile_stage", type=str, help="stage to run under cProfile"
+    )
+    args = psr.parse_args()
+    if args.profile is not None:
+        profiling.enable(args.profile, args.profile_stage)
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        score(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+'''
+Generate JUNO-like geometry, training and concat files from an analytic probe.
+
+The files have the same datasets and dtypes as geo.h5, data/*.h5 and concat.h5,
+so that histogram.py, probe.py and draw.py can run without downloading data.
+The PEs are drawn from the analytic probe `AnalyticProbe`, which can then be
+scored against probes built from the synthetic training files.
+'''
+
+import argparse
+import os
+import h5py
+import numpy as np
+from coefficient import ProbeBase
+
+# PMT数量
+N = 17612
+# 液闪区域半径(mm)
+R0 = 17710
+# probe函数积分上限(ns)
+T_MAX = 1000
+# PMT所在球面半径与液闪区域半径之比
+RHO = 19500 / R0
+# 光在液闪中的等效速度(mm/ns)
+C_EFF = 190
+# PE时间分布的衰减时间(ns)
+TAU = 30
+# 球心处顶点在每个PMT上的期望PE数
+LAMBDA0 = 0.05
+
+class AnalyticProbe(ProbeBase):
+    '''
+    The analytic probe the synthetic PEs are drawn from.
+
+    A vertex at relative coordinates (r, θ) is at distance
+    D = sqrt(RHO² + r² - 2·RHO·r·cosθ) from the PMT (in units of R0).
+    The PMT sees λ = LAMBDA0 · RHO² / D² PEs in total, delayed by
+    t_D = D·R0 / C_EFF and then exponentially distributed with time constant TAU:
+
+        R(r, θ, t) = λ / TAU · exp(-(t - t_D) / TAU),  t > t_D.
+    '''
+
+    def __init__(self, lambda0=LAMBDA0):
+        self.lambda0 = lambda0
+
+    def get_distance(self, rs, thetas):
+        return np.sqrt(RHO**2 + np.asarray(rs)**2 - 2 * RHO * rs * np.cos(thetas))
+
+    def get_lambda(self, rs, thetas):
+        '''
+        Return the expected number of PEs over all times and the delay t_D.
+        '''
+        d = self.get_distance(rs, thetas)
+        return self.lambda0 * RHO**2 / d**2, d * R0 / C_EFF
+
+    def get_lc(self, rs, thetas, ts):
+        lam, delay = self.get_lambda(rs, thetas)
+        dt = np.asarray(ts) - delay
+        return np.where(dt > 0, lam / TAU * np.exp(-np.maximum(dt, 0) / TAU), 0)
+
+    def get_lc_antiderivative(self, rs, thetas, ts):
+        lam, delay = self.get_lambda(rs, thetas)
+        return lam * -np.expm1(-np.maximum(np.asarray(ts) - delay, 0) / TAU)
+
+    def get_mu(self, rs, thetas):
+        return self.get_lc_antiderivative(rs, thetas, np.full(np.shape(rs), T_MAX))
+
+def pmt_positions(n_pmt):
+    '''
+    Return (theta, phi) in degrees of `n_pmt` PMTs spread evenly on the
+    sphere by a Fibonacci lattice.
+    '''
+    k = np.arange(n_pmt) + 0.5
+    theta = np.arccos(1 - 2 * k / n_pmt)
+    phi = np.mod(np.pi * (1 + 5**0.5) * k, 2 * np.pi)
+    return np.rad2deg(theta), np.rad2deg(phi)
+
+def write_geometry(filename, n_pmt=N):
+    '''
+    Write a geometry file with `n_pmt` PMTs.
+    '''
+    geo = np.zeros(n_pmt, dtype=[('ChannelID', '<i4'), ('theta', '<f8'),
+                                 ('phi', '<f8')])
+    geo['ChannelID'] = np.arange(n_pmt)
+    geo['theta'], geo['phi'] = pmt_positions(n_pmt)
+    with h5py.File(filename, 'w') as h5file_w:
+        h5file_w.create_dataset('Geometry', data=geo)
+
+def simulate(pmt, n_vertex, rng, truth, chunk=256):
+    '''
+    Simulate `n_vertex` vertices uniform in the liquid scintillator.
+
+    Yields, per chunk of vertices, the index of the first vertex, the vertex
+    positions (mm), the (r, θ) of every vertex×PMT pair with shape
+    (chunk, n_pmt), and the vertex index within the chunk, PMT index and time
+    of every PE.
+    '''
+    for start in range(0, n_vertex, chunk):
+        n = min(chunk, n_vertex - start)
+        u = rng.normal(size=(n, 3))
+        u /= np.linalg.norm(u, axis=1)[:, None]
+        r = rng.uniform(size=n) ** (1/3)
+        cos = np.clip(u @ pmt.T, -1, 1)
+        rs = np.broadcast_to(r[:, None], cos.shape)
+        thetas = np.arccos(cos)
+        lam, delay = truth.get_lambda(rs, thetas)
+        counts = rng.poisson(lam)
+        vertex, channel = np.nonzero(counts)
+        repeat = counts[vertex, channel]
+        vertex, channel = np.repeat(vertex, repeat), np.repeat(channel, repeat)
+        ts = delay[vertex, channel] + rng.exponential(TAU, size=len(vertex))
+        yield start, u * r[:, None] * R0, rs, thetas, vertex, channel, ts
+
+def write_training(filename, pmt, n_vertex, seed, truth=AnalyticProbe(),
+                   time_field="PETime"):
+    '''
+    Write a training file with `n_vertex` vertices, in the layout of data/*.h5.
+    '''
+    rng = np.random.default_rng(seed)
+    vertices, pes = [], []
+    for start, xyz, _, _, vertex, channel, ts in simulate(pmt, n_vertex, rng, truth):
+        vertices.append(xyz)
+        pes.append((vertex + start, channel, ts))
+    xyz = np.concatenate(vertices)
+    particle = np.zeros(n_vertex, dtype=[('EventID', '<i4'), ('x', '<f8'),
+        ('y', '<f8'), ('z', '<f8'), ('Ek', '<f8'), ('Evis', '<f8')])
+    particle['EventID'] = np.arange(n_vertex)
+    particle['x'], particle['y'], particle['z'] = xyz.T
+    particle['Ek'] = particle['Evis'] = 1
+    vertex, channel, ts = (np.concatenate(a) for a in zip(*pes))
+    pe = np.zeros(len(vertex), dtype=[('EventID', '<i4'), ('ChannelID', '<i4'),
+                                      (time_field, '<f8')])
+    pe['EventID'], pe['ChannelID'], pe[time_field] = vertex, channel, ts
+    with h5py.File(filename, 'w') as h5file_w:
+        h5file_w.create_dataset('ParticleTruth', data=particle)
+        h5file_w.create_dataset('PETruth', data=pe)
+
+def write_concat(filename, pmt, n_vertex, seed, truth=AnalyticProbe()):
+    '''
+    Write a concat file with `n_vertex` vertices, in the layout of concat.h5.
+    '''
+    rng = np.random.default_rng(seed)
+    with h5py.File(filename, 'w') as h5file_w:
+        concat = h5file_w.create_dataset('Concat', shape=(0,), maxshape=(None,),
+            chunks=(2**16,), dtype=[('r', '<f8'), ('theta', '<f8'), ('t', '<f8')])
+        vertices = h5file_w.create_dataset('Vertices', shape=(0,), maxshape=(None,),
+            chunks=(2**16,), dtype=[('r', '<f8'), ('theta', '<f8')])
+        for _, _, rs, thetas, vertex, channel, ts in simulate(pmt, n_vertex, rng, truth):
+            pairs = np.zeros(rs.size, dtype=vertices.dtype)
+            pairs['r'], pairs['theta'] = rs.ravel(), thetas.ravel()
+            vertices.resize((len(vertices) + len(pairs),))
+            vertices[-len(pairs):] = pairs
+            pes = np.zeros(len(ts), dtype=concat.dtype)
+            pes['r'] = rs[vertex, channel]
+            pes['theta'] = thetas[vertex, channel]
+            pes['t'] = ts
+            concat.resize((len(concat) + len(pes),))
+            concat[len(concat) - len(pes):] = pes
+
+def main():
+    '''
+    Write geo.h5, data/<seed>.h5 and concat.h5 into a directory.
+
+    ```bash
+    python3 synthetic.py -o synth --pmts 17612 --vertices 10000 --files 1 --test-vertices 1000
+    ```
+    '''
+    psr = argparse.ArgumentParser()
+    psr.add_argument("-o", "--output", dest="opt", type=str, help="output directory")
+    psr.add_argument("--pmts", dest="pmts", type=int, default=N, help="number of PMTs")
+    psr.add_argument("--vertices", dest="vertices", type=int, default=10000,
+                     help="vertices per training file")
+    psr.add_argument("--files", dest="files", type=int, default=1,
+                     help="number of training files")
+    psr.add_argument("--test-vertices", dest="test_vertices", type=int, default=1000,
+                     help="vertices of the concat file")
+    psr.add_argument("--lambda0", dest="lambda0", type=float, default=LAMBDA0,
+                     help="expected PEs per PMT of a vertex at the center")
+    psr.add_argument("--time-field", dest="time_field", type=str, default="PETime",
+                     help="name of the PE time field in PETruth")
+    psr.add_argument("--seed", dest="seed", type=int, default=16001,
+                     help="seed of the first training file")
+    args = psr.parse_args()
+
+    from histogram import read_pmt
+
+    truth = AnalyticProbe(args.lambda0)
+    os.makedirs(os.path.join(args.opt, "data"), exist_ok=True)
+    geo_file = os.path.join(args.opt, "geo.h5")
+    write_geometry(geo_file, args.pmts)
+    pmt = read_pmt(geo_file)
+    for seed in range(args.seed, args.seed + args.files):
+        write_training(os.path.join(args.opt, "data", f"{seed}.h5"), pmt,
+                       args.vertices, seed, truth, args.time_field)
+    write_concat(os.path.join(args.opt, "concat.h5"), pmt, args.test_vertices,
+                 args.seed - 1, truth)
+
+if __name__ == "__main__":
+    main()